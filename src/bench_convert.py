@@ -0,0 +1,99 @@
+"""Compare the SimpleITK and NumPy conversion backends on a synthetic series.
+
+python -m src.bench_convert --slices 300 --size 512 --modality PT --threads 1 4 8
+"""
+import argparse
+import pathlib
+import tempfile
+import time
+from typing import List
+
+import numpy as np
+import SimpleITK as sitk
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, PositronEmissionTomographyImageStorage, generate_uid
+
+from src.image_io import NUMPY, SITK, read_image
+from src.volume_io import VolumeGeometry
+
+parser = argparse.ArgumentParser("benchmark the conversion backends of src.conv2nii on a synthetic series")
+parser.add_argument("--slices", help="number of slices of the series", type=int, default=200)
+parser.add_argument("--size", help="rows and columns of the slices", type=int, default=512)
+parser.add_argument("--modality", help="CT: integer rescale, PT: a float slope per slice", choices=["CT", "PT"],
+                    default="CT")
+parser.add_argument("--threads", help="thread counts to try", type=int, nargs="+", default=[1, 4])
+parser.add_argument("--repeat", help="number of runs of each backend", type=int, default=3)
+parser.add_argument("--dest", help="folder where to write the series, defaults to a temporary folder")
+
+PIXEL_SPACING = [0.8, 0.8]
+SLICE_SPACING = 1.25
+
+
+def write_series(folder: pathlib.Path, slices: int, size: int, modality: str) -> List[str]:
+    """Write a series of random slices, and return its files ordered along the slice axis."""
+    rng = np.random.default_rng(0)
+    sop_class = CTImageStorage if modality == "CT" else PositronEmissionTomographyImageStorage
+    series_uid, study_uid = generate_uid(), generate_uid()
+    files = []
+    for index in range(slices):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = sop_class
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = FileDataset(None, {}, file_meta=meta, preamble=b"\0" * 128)
+        ds.SOPClassUID, ds.SOPInstanceUID = sop_class, meta.MediaStorageSOPInstanceUID
+        ds.Modality, ds.SeriesInstanceUID, ds.StudyInstanceUID = modality, series_uid, study_uid
+        ds.InstanceNumber = index + 1
+        ds.ImagePositionPatient = [-200.0, -200.0, index * SLICE_SPACING]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = PIXEL_SPACING
+        ds.Rows = ds.Columns = size
+        ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, "MONOCHROME2"
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 12, 11
+        if modality == "CT":
+            ds.PixelRepresentation, ds.RescaleSlope, ds.RescaleIntercept = 0, 1, -1024
+        else:
+            ds.PixelRepresentation, ds.RescaleSlope, ds.RescaleIntercept = 0, f"{rng.uniform(0.1, 2):.6f}", 0
+        ds.PixelData = rng.integers(0, 4096, (size, size), dtype=np.uint16).tobytes()
+        file = folder / f"{index:05d}.dcm"
+        ds.save_as(str(file), enforce_file_format=True)
+        files.append(str(file))
+    return files
+
+
+def best_time(repeat: int, *args, **kwargs) -> float:
+    """Best time of `repeat` reads of the series, in s."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        read_image(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(args):
+    with tempfile.TemporaryDirectory(dir=args.dest) as tmp_dir:
+        files = write_series(pathlib.Path(tmp_dir), args.slices, args.size, args.modality)
+        positions = np.array([[-200.0, -200.0, index * SLICE_SPACING] for index in range(args.slices)])
+        geometry = VolumeGeometry.from_slices(positions, np.array([1.0, 0, 0, 0, 1, 0]), np.array(PIXEL_SPACING))
+        expected = read_image(files, SITK)
+        image = read_image(files, NUMPY, geometry)
+        if not (np.allclose(sitk.GetArrayViewFromImage(expected), sitk.GetArrayViewFromImage(image))
+                and np.allclose(expected.GetOrigin(), image.GetOrigin())
+                and np.allclose(expected.GetSpacing(), image.GetSpacing())
+                and np.allclose(expected.GetDirection(), image.GetDirection())):
+            print("the backends do not read the same volume")
+        megabytes = image.GetNumberOfPixels() * image.GetSizeOfPixelComponent() / 1e6
+        print(f"{args.slices} slices of {args.size}x{args.size}, {megabytes:.0f} MB "
+              f"{image.GetPixelIDTypeAsString()} volume")
+        del expected, image
+        for threads in args.threads:
+            sitk.ProcessObject_SetGlobalDefaultNumberOfThreads(threads)
+            seconds = best_time(args.repeat, files, SITK)
+            print(f"{f'sitk {threads} threads':>20}: {seconds:6.2f} s, {args.slices / seconds:8.0f} slices/s")
+            seconds = best_time(args.repeat, files, NUMPY, geometry, threads)
+            print(f"{f'numpy {threads} threads':>20}: {seconds:6.2f} s, {args.slices / seconds:8.0f} slices/s")
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
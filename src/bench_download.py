@@ -0,0 +1,86 @@
+"""Benchmark src.tcia download against a local mock of the TCIA service.
+
+python -m src.bench_download --series 50 --njobs 1 4 8 16 --engines thread process --latency 0.1
+
+The mock server and each download run in their own process, so that they
+do not share a GIL. Every download starts from an empty folder.
+"""
+import argparse
+import csv
+import itertools
+import json
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser("benchmark the downloader against src.mock_tcia")
+parser.add_argument("--series", help="number of series in the manifest", type=int, default=50)
+parser.add_argument("--njobs", help="values of --njobs to try", type=int, nargs="+", default=[1, 4, 8, 16])
+parser.add_argument("--engines", help="engines to try", nargs="+", default=["thread", "process"])
+parser.add_argument("--modes", help="zip: save archives, extract: --extract", nargs="+", default=["zip"])
+parser.add_argument("--repeat", help="number of runs of each configuration", type=int, default=1)
+parser.add_argument("--output", help="also write the results in this CSV file")
+parser.add_argument("--dest", help="folder for the downloads, defaults to a temporary folder")
+parser.add_argument("--mock-args", help="arguments given to src.mock_tcia, e.g. \"--latency 0.1 --bandwidth 20M\"",
+                    default="")
+
+RESULT_FIELDS = ("engine", "mode", "njobs", "run", "seconds", "gigabytes", "rate_mb_s", "failed")
+
+
+def write_manifest(path: pathlib.Path, count: int) -> pathlib.Path:
+    series = "\n".join(f"1.3.6.1.4.1.9328.50.1.{i}" for i in range(count))
+    path.write_text(f"manifestVersion=3.0\nListOfSeriesToDownload=\n{series}\n")
+    return path
+
+
+def start_mock(mock_args: str):
+    mock = subprocess.Popen(
+        [sys.executable, "-m", "src.mock_tcia", "--port", "0", *mock_args.split()],
+        stdout=subprocess.PIPE, text=True,
+    )
+    url = mock.stdout.readline().split()[-1]
+    return mock, url
+
+
+def run_download(manifest: pathlib.Path, dest: pathlib.Path, url: str, engine: str, mode: str, njobs: int):
+    command = [sys.executable, "-m", "src.tcia", "download", str(manifest), str(dest),
+               "--njobs", str(njobs), "--engine", engine, "--endpoint", url]
+    if mode == "extract":
+        command.append("--extract")
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    seconds = time.perf_counter() - start
+    with (dest / manifest.name / (manifest.name + ".report.json")).open() as report_file:
+        report = json.load(report_file)
+    return seconds, report
+
+
+def main(args):
+    mock, url = start_mock(args.mock_args)
+    results = []
+    try:
+        with tempfile.TemporaryDirectory(dir=args.dest) as tmp_dir:
+            tmp_dir = pathlib.Path(tmp_dir)
+            manifest = write_manifest(tmp_dir / "bench.tcia", args.series)
+            configurations = itertools.product(args.engines, args.modes, args.njobs, range(args.repeat))
+            for index, (engine, mode, njobs, run) in enumerate(configurations):
+                seconds, report = run_download(manifest, tmp_dir / str(index), url, engine, mode, njobs)
+                result = dict(zip(RESULT_FIELDS, (
+                    engine, mode, njobs, run, round(seconds, 2), round(report["transferred"] / 1e9, 3),
+                    round(report["transferred"] / seconds / 1e6, 1), report["failed"],
+                )))
+                print(" | ".join(f"{key} {value}" for key, value in result.items()), flush=True)
+                results.append(result)
+    finally:
+        mock.terminate()
+    if args.output is not None:
+        with open(args.output, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=RESULT_FIELDS)
+            writer.writeheader()
+            writer.writerows(results)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,89 @@
+"""Compare the download write paths against a local HTTP server.
+
+python -m src.bench_write --size 1G --buffer-sizes 64K 1M 4M
+"""
+import argparse
+import os
+import pathlib
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from src.cache import parse_size
+from src.write_path import WriteOptions, stream_to_file
+
+parser = argparse.ArgumentParser("benchmark the download write path against a local HTTP server")
+parser.add_argument("--size", help="size of the served file, e.g. 512M", default="512M")
+parser.add_argument("--buffer-sizes", help="buffer sizes to try", nargs="+", default=["64K", "1M", "4M"])
+parser.add_argument("--repeat", help="number of runs of each write path", type=int, default=3)
+parser.add_argument("--dest", help="folder where to write, defaults to a temporary folder")
+
+
+def serve_bytes(size: int) -> ThreadingHTTPServer:
+    """Serve `size` bytes on any GET, from a background thread."""
+    block = os.urandom(1 << 20)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            remaining = size
+            while remaining:
+                sent = min(remaining, len(block))
+                self.wfile.write(block[:sent])
+                remaining -= sent
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def iter_content_write(session: requests.Session, url: str, dest: pathlib.Path) -> int:
+    """The write path of tcia_dl before WriteOptions."""
+    written = 0
+    with session.get(url, stream=True) as r, dest.open("wb") as file:
+        for chunk in r.iter_content(chunk_size=8192):
+            if chunk:
+                written += file.write(chunk)
+    return written
+
+
+def buffered_write(session: requests.Session, url: str, dest: pathlib.Path, options: WriteOptions) -> int:
+    with session.get(url, stream=True, headers={"Accept-Encoding": "identity"}) as r, dest.open("wb") as file:
+        return stream_to_file(r.raw, file, options, int(r.headers["Content-Length"]))
+
+
+def best_rate(func, repeat: int, *args) -> float:
+    """Best throughput of `repeat` runs, in MB/s."""
+    rates = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        written = func(*args)
+        rates.append(written / (time.perf_counter() - start) / 1e6)
+    return max(rates)
+
+
+def main(args):
+    size = parse_size(args.size)
+    server = serve_bytes(size)
+    url = f"http://127.0.0.1:{server.server_port}/getImage"
+    with tempfile.TemporaryDirectory(dir=args.dest) as tmp_dir, requests.Session() as session:
+        dest = pathlib.Path(tmp_dir) / "series.zip"
+        rate = best_rate(iter_content_write, args.repeat, session, url, dest)
+        print(f"{'iter_content 8K':>28}: {rate:8.1f} MB/s")
+        for buffer_size in args.buffer_sizes:
+            options = WriteOptions(parse_size(buffer_size))
+            rate = best_rate(buffered_write, args.repeat, session, url, dest, options)
+            print(f"{'readinto ' + buffer_size:>28}: {rate:8.1f} MB/s")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,192 @@
+"""Store shared by all manifests, holding each series once.
+
+Series are downloaded in the store, under their SeriesInstanceUID, and the
+manifest folders are populated with hardlinks (or reflinks, or copies as a
+last resort) to the stored files. The store keeps an index of its entries
+with their size and last use, to evict the least recently used ones.
+"""
+import errno
+import fcntl
+import logging
+import os
+import pathlib
+import re
+import shutil
+import sqlite3
+import time
+from dataclasses import replace
+from typing import Callable, List, Sequence, Tuple
+
+from src.file_io import disk_size
+
+log = logging.getLogger(__name__)
+
+FICLONE = 0x40049409  # linux/fs.h, clone a file on btrfs, xfs...
+SIZE_UNITS = {"": 1, "K": 1e3, "M": 1e6, "G": 1e9, "T": 1e12}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    name TEXT PRIMARY KEY,
+    series_uid TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+"""
+
+
+def parse_size(size: str) -> int:
+    """Convert a human readable size, like 500G, to bytes."""
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)B?\s*", size.upper())
+    if match is None:
+        raise ValueError(f"Invalid size: {size}")
+    value, unit = match.groups()
+    return int(float(value) * SIZE_UNITS[unit])
+
+
+def _clone_file(source: pathlib.Path, dest: pathlib.Path) -> None:
+    try:
+        os.link(source, dest)
+        return
+    except OSError as error:
+        if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    try:
+        with source.open("rb") as src, dest.open("wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return
+    except OSError:
+        log.debug("no reflink support for %s, copying it", str(dest))
+    shutil.copy2(source, dest)
+
+
+def link_into(source: pathlib.Path, dest: pathlib.Path) -> None:
+    """Make dest a linked copy of the file or directory source.
+
+    Parameters
+    ----------
+    source : pathlib.Path
+        A file or a directory of the store
+    dest : pathlib.Path
+        Where to create the copy. Nothing is done if it exists.
+    """
+    if dest.exists():
+        return
+    if not source.is_dir():
+        _clone_file(source, dest)
+        return
+    part_dest = dest.with_name(dest.name + ".part")
+    shutil.rmtree(part_dest, ignore_errors=True)
+    for file in source.rglob("*"):
+        target = part_dest / file.relative_to(source)
+        if file.is_dir():
+            target.mkdir(parents=True, exist_ok=True)
+        else:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            _clone_file(file, target)
+    part_dest.mkdir(parents=True, exist_ok=True)
+    os.replace(part_dest, dest)
+
+
+def fetch_through_cache(fetch: Callable, store: pathlib.Path, serie_id: str, dest: pathlib.Path):
+    """Download a series in the store, then link it to dest.
+
+    Runs in the download workers. A series already in the store is not
+    downloaded again.
+    """
+    result = fetch(serie_id, store / serie_id)
+    link_into(result.path, dest)
+    return replace(result, path=dest)
+
+
+def fetch_and_link(fetch: Callable, serie_id: str, dest: pathlib.Path, links: Sequence[pathlib.Path] = ()):
+    """Download a series to dest, then link it to the other destinations.
+
+    Runs in the download workers, for series listed in several manifests.
+    """
+    result = fetch(serie_id, dest)
+    for link in links:
+        link_into(result.path, link)
+    return result
+
+
+class SeriesCache:
+    """Index of a series store.
+
+    It is also a listener for src.scheduler.run_downloads, and must be used
+    from the thread running the scheduler only.
+
+    Parameters
+    ----------
+    root : pathlib.Path
+        The cache folder. Archives and extracted series are stored in
+        separate sub folders, named after `kind`.
+    kind : str
+        "archives" or "extracted"
+    """
+
+    def __init__(self, root: pathlib.Path, kind: str = "archives"):
+        self.root = pathlib.Path(root).expanduser()
+        self.store = self.root / kind
+        self.store.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.root / "cache.sqlite"))
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def started(self, series_uid: str) -> None:
+        pass
+
+    def failed(self, series_uid: str, error: Exception, final: bool) -> None:
+        pass
+
+    def succeeded(self, series_uid: str, result) -> None:
+        entry = self.store / series_uid
+        name = str(entry.relative_to(self.root))
+        with self.connection:
+            updated = self.connection.execute(
+                "UPDATE entries SET last_used = ? WHERE name = ?", (time.time(), name)
+            ).rowcount
+            if not updated:
+                self.connection.execute(
+                    "INSERT INTO entries VALUES (?, ?, ?, ?)", (name, series_uid, disk_size(entry), time.time())
+                )
+
+    def usage(self) -> Tuple[int, int]:
+        """Number of entries and their total size in bytes."""
+        return self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+
+    def evict(self, max_size: int) -> List[str]:
+        """Remove the least recently used entries until the store fits in max_size.
+
+        Files still linked from a manifest folder keep using disk space until
+        they are deleted there too.
+
+        Returns
+        -------
+        List[str]
+            The evicted series.
+        """
+        _, total = self.usage()
+        evicted = []
+        rows = self.connection.execute("SELECT name, series_uid, size FROM entries ORDER BY last_used").fetchall()
+        for name, series_uid, size in rows:
+            if total <= max_size:
+                break
+            entry = self.root / name
+            if entry.is_dir():
+                shutil.rmtree(entry)
+            elif entry.exists():
+                entry.unlink()
+            with self.connection:
+                self.connection.execute("DELETE FROM entries WHERE name = ?", (name,))
+            total -= size
+            evicted.append(series_uid)
+        return evicted
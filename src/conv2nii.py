@@ -1,27 +1,403 @@
+"""Convert the series of the metadata DB to nii.gz, one process per volume.
+
+The volumes of each series, their ordered files and their headers all come
+from the metadata DB written by src.create_csv_db, no dicom header is read
+again before the conversion:
+
+python -m src.conv2nii /data/tcia/metadatas.csv /data/nii --jobs 8 --threads 2 --modality CT --modality PT
+
+With --backend numpy, the slices are decoded by pydicom into one NumPy array
+per volume (see src.volume_io) instead of read by SimpleITK. Each volume can
+be written in several formats at once, see src.volume_formats:
+
+python -m src.conv2nii /data/tcia/metadatas.parquet /data/nii --format nii.gz npy --level 1
+
+Outputs already there and readable are skipped, so an interrupted
+conversion can be started again.
+"""
 import argparse
+import itertools
+import logging
 import operator
+import os
+import pathlib
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, replace
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+from src.image_io import BACKENDS, SITK, files_to_nii
+from src.metadata_index import MEMBER_SEPARATOR
+from src.series_index import plain_value
+from src.utils import get_valid_filepath
+from src.volume_formats import FORMATS, GZIP_LEVEL, NII, NII_GZ, ZARR, ZARR_CHUNKS, output_path
+from src.volume_io import VolumeGeometry
+
+log = logging.getLogger(__name__)
+
+CONVERTED = "converted"
+SKIPPED = "skipped"
+FAILED = "failed"
+GEOMETRY_KEYS = ["ImagePositionPatient", "ImageOrientationPatient", "AcquisitionNumber", "InstanceNumber"]
+ID_KEYS = ["SeriesInstanceUID", "StudyInstanceUID", "PatientID", "Modality"]
+# rows of metadatas.csv read at once when looking for the headers of the volumes
+CSV_CHUNK_SIZE = 100_000
+AXIAL = np.array([1.0, 0.0, 0.0, 0.0, 1.0, 0.0])
+# a step larger than this times the median spacing of a volume cuts it in two
+GAP_FACTOR = 1.5
+# slices closer than this along the normal, in mm, are at the same position
+DUPLICATE_TOLERANCE = 0.01
 
 parser = argparse.ArgumentParser("convert dicom files to nii.gz")
-parser.add_argument("db", help="location of the csv create by the create_csv_db command")
+parser.add_argument("db", help="location of the csv create by the create_csv_db command, or of the parquet file")
+parser.add_argument("dest", help="the folder where to write PatientID/StudyInstanceUID/Modality_SeriesInstanceUID.nii.gz "
+                                 "(with a _N suffix for series of several volumes)")
+parser.add_argument("--jobs", "-j", help="Number of volumes converted at once", default=4, type=int)
+parser.add_argument("--threads", help="Number of threads of each conversion, to read the slices and to compress "
+                                      "(default: cpus / jobs)", type=int)
+parser.add_argument("--format", help="formats to write, several can be given: nii.gz, nii and npy (both "
+                                     "uncompressed, to memory-map), zarr (chunked, needs zarr)",
+                    choices=FORMATS, nargs="+", default=[NII_GZ])
+parser.add_argument("--level", help="gzip level of the nii.gz files, 1 is fast, 9 small", type=int,
+                    default=GZIP_LEVEL, choices=range(1, 10))
+parser.add_argument("--chunks", help="slices, rows and columns of the chunks of the zarr arrays", type=int, nargs=3,
+                    default=list(ZARR_CHUNKS))
+parser.add_argument("--modality", help="only convert the series of this modality (repeatable)", action="append")
+parser.add_argument("--min-slices", help="only convert the volumes with at least this number of slices", type=int)
+parser.add_argument("--backend", help="read the slices with SimpleITK, or decode them with pydicom into a NumPy array",
+                    choices=BACKENDS, default=SITK)
+
+
+@dataclass
+class ConversionOptions:
+    backend: str = SITK  # see image_io.read_image
+    threads: Optional[int] = None  # of each conversion, cpus / jobs if None
+    formats: Sequence[str] = (NII_GZ,)
+    level: int = GZIP_LEVEL
+    chunks: Sequence[int] = ZARR_CHUNKS
+
+
+@dataclass
+class VolumeJob:
+    series_uid: str
+    files: List[str]  # ordered along the slice axis
+    stem: pathlib.Path  # of the outputs, whose extension is the format
+    metadata: Dict  # headers of the first slice, from the metadata DB
+    geometry: Optional[VolumeGeometry]  # None if the slices can not be placed in space
+
+
+def dest_of(dest_folder: pathlib.Path, ids: Dict, volume: Optional[int] = None) -> pathlib.Path:
+    patient, study, modality, series_uid = (
+        get_valid_filepath(ids[key]) for key in ("PatientID", "StudyInstanceUID", "Modality", "SeriesInstanceUID")
+    )
+    suffix = "" if volume is None else f"_{volume}"
+    return dest_folder / patient / study / f"{modality}_{series_uid}{suffix}"
+
+
+def plan_jobs(db: pathlib.Path, dest_folder: pathlib.Path, modality: Optional[List[str]] = None,
+              min_slices: Optional[int] = None) -> Tuple[List[VolumeJob], List[Tuple[str, str]]]:
+    """One job per volume of the series of the DB, the largest first.
+
+    Returns
+    -------
+    Tuple[List[VolumeJob], List[Tuple[str, str]]]
+        The jobs, and the series which can not be converted with the reason why.
+    """
+    table = read_db(db)
+    if modality:
+        table = table[table["Modality"].isin(modality)].reset_index(drop=True)
+    ids = table.reindex(columns=ID_KEYS).apply(lambda column: column.astype(str).str.strip("'"))
+    locations = locations_of(table)
+    geometry = _geometry(table)
+    pixel_spacings = _vectors(table["PixelSpacing"] if "PixelSpacing" in table
+                              else pd.Series(np.nan, index=table.index), 2)
+    volumes, rejected = [], []
+    for series_uid, series_volumes in itertools.groupby(volume_rows(table, geometry), key=operator.itemgetter(0)):
+        series_volumes = [rows for _, rows in series_volumes]
+        if any(MEMBER_SEPARATOR in str(location) for location in locations[series_volumes[0]]):
+            rejected.append((series_uid, "in a zip archive, extract it first"))
+            continue
+        for number, rows in enumerate(series_volumes):
+            if min_slices is not None and len(rows) < min_slices:
+                continue
+            volume = None if len(series_volumes) == 1 else number
+            volumes.append((series_uid, rows, dest_of(dest_folder, ids.iloc[rows[0]], volume)))
+    headers = read_rows(db, table["row"].to_numpy()[[rows[0] for _, rows, _ in volumes]])
+    jobs = [VolumeJob(series_uid, list(locations[rows]), stem, headers[table["row"].iat[rows[0]]],
+                      volume_geometry(geometry, pixel_spacings, rows))
+            for series_uid, rows, stem in volumes]
+    jobs.sort(key=lambda job: len(job.files), reverse=True)
+    return jobs, rejected
+
+
+def volume_geometry(geometry: Tuple[np.ndarray, ...], pixel_spacings: np.ndarray,
+                    rows: np.ndarray) -> Optional[VolumeGeometry]:
+    positions, orientations, _, _ = geometry
+    try:
+        return VolumeGeometry.from_slices(positions[rows], orientations[rows[0]], pixel_spacings[rows[0]])
+    except ValueError:
+        return None
+
+
+def _toml_value(value):
+    return value.item() if isinstance(value, np.generic) else plain_value(value)
+
+
+def read_rows(db: pathlib.Path, rows: Iterable[int]) -> Dict[int, Dict]:
+    """Whole records of some rows of metadatas.csv or metadatas.parquet, without missing values.
+
+    The UIDs and lists that metadatas.csv holds as their repr are parsed back
+    into plain values, as read from metadatas.parquet.
+
+    The file is read by chunks, so that only the given rows are kept in memory.
+    """
+    wanted = set(int(row) for row in rows)
+    records = {}
+    if db.suffix == ".parquet":
+        import pyarrow.parquet as pq  # as for --format parquet of src.create_csv_db
+        offset = 0
+        for batch in pq.ParquetFile(db).iter_batches():
+            selected = [row for row in range(offset, offset + batch.num_rows) if row in wanted]
+            for row, record in zip(selected, batch.take([row - offset for row in selected]).to_pylist()):
+                records[row] = {key: value for key, value in record.items() if value is not None}
+            offset += batch.num_rows
+        return records
+    for chunk in pd.read_csv(db, chunksize=CSV_CHUNK_SIZE):
+        for row, record in chunk[chunk.index.isin(wanted)].iterrows():
+            records[row] = {key: _toml_value(value) for key, value in record.items() if not pd.isna(value)}
+    return records
+
+
+def is_valid_output(dest: pathlib.Path) -> bool:
+    """Whether dest exists and, for a NIfTI file, its header can be read.
+
+    The other formats are moved in place once complete.
+    """
+    if not dest.exists():
+        return False
+    if not dest.name.endswith((f".{NII}", f".{NII_GZ}")):
+        return True
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(dest))
+    try:
+        reader.ReadImageInformation()
+    except RuntimeError:
+        return False
+    return True
+
+
+def _init_worker(threads: int) -> None:
+    sitk.ProcessObject_SetGlobalDefaultNumberOfThreads(threads)
+
+
+def convert_job(job: VolumeJob, options: ConversionOptions) -> Tuple[str, str]:
+    """Worker task: write the formats of a volume not written already.
+
+    Returns
+    -------
+    Tuple[str, str]
+        The status of the job, and the error if it failed.
+    """
+    formats = [fmt for fmt in options.formats if not is_valid_output(output_path(job.stem, fmt))]
+    if not formats:
+        return SKIPPED, ""
+    try:
+        for fmt in formats:
+            if output_path(job.stem, fmt).is_file():
+                output_path(job.stem, fmt).unlink()  # not readable, left by an older version or a broken disk
+        files_to_nii(job.files, [output_path(job.stem, fmt) for fmt in formats], job.metadata, options.backend,
+                     job.geometry, options.threads, options.level, options.chunks)
+    except Exception as error:  # one bad series must not stop the others
+        return FAILED, f"{type(error).__name__}: {error}"
+    return CONVERTED, ""
+
+
+def convert_all(jobs: List[VolumeJob], n_jobs: int, options: ConversionOptions = ConversionOptions()) -> dict:
+    """Run the jobs in a pool of n_jobs processes, each with a budget of options.threads.
+
+    Returns
+    -------
+    dict
+        The number of jobs by status.
+    """
+    threads = options.threads or max(1, (os.cpu_count() or 1) // n_jobs)
+    options = replace(options, threads=threads)
+    counts = {CONVERTED: 0, SKIPPED: 0, FAILED: 0}
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(threads,)) as executor:
+        futures = {executor.submit(convert_job, job, options): job for job in jobs}
+        for done, future in enumerate(as_completed(futures), 1):
+            job = futures[future]
+            status, error = future.result()
+            counts[status] += 1
+            if status == FAILED:
+                log.error("Series %s failed: %s", job.series_uid, error)
+            elif status == CONVERTED:
+                log.info("[%d/%d] %s", done, len(jobs), job.stem)
+    return counts
+
+
+def main(argv=None) -> None:
+    args = parser.parse_args(argv)
+    db = pathlib.Path(args.db).expanduser().resolve()
+    if not db.is_file():
+        sys.exit(f"{db} not found, run src.create_csv_db first")
+    if ZARR in args.format:
+        try:
+            import zarr  # only checked here, used by src.volume_formats
+        except ImportError:
+            sys.exit("--format zarr needs zarr: pip install zarr")
+    jobs, rejected = plan_jobs(db, pathlib.Path(args.dest).expanduser(), args.modality, args.min_slices)
+    for series_uid, reason in rejected:
+        log.warning("Series %s skipped: %s", series_uid, reason)
+    options = ConversionOptions(args.backend, args.threads, args.format, args.level, args.chunks)
+    counts = convert_all(jobs, args.jobs, options)
+    print(f"{counts[CONVERTED]} volumes converted, {counts[SKIPPED]} already done, {counts[FAILED]} failed, "
+          f"{len(rejected)} series not convertible")
+
+
+def _vectors(column: pd.Series, size: int) -> np.ndarray:
+    """(n, size) array of a multi-valued column, NaN where the value is missing or invalid.
+
+    Values are lists in metadatas.parquet, and their repr in metadatas.csv.
+    """
+    vectors = np.full((len(column), size), np.nan)
+    present = column.notna().to_numpy()
+    values = column[present]
+    if not len(values):
+        return vectors
+    if isinstance(values.iloc[0], str):
+        codes, uniques = pd.factorize(values)
+        vectors[present] = _parse_vectors(uniques, size)[codes]
+        return vectors
+    sizes = values.map(len).to_numpy()
+    rows = np.flatnonzero(present)[sizes == size]
+    if len(rows):
+        vectors[rows] = np.stack([np.asarray(value, dtype=float) for value in values[sizes == size]])
+    return vectors
+
+
+def _parse_vectors(texts: Sequence[str], size: int) -> np.ndarray:
+    """Parse reprs of lists of numbers, like "[1.0, 0.0, 0.0]", all at once when they are well formed."""
+    try:
+        numbers = np.array(",".join(texts).replace("[", "").replace("]", "").split(","), dtype=float)
+        if len(numbers) == len(texts) * size:
+            return numbers.reshape(-1, size)
+    except ValueError:
+        pass
+    vectors = np.full((len(texts), size), np.nan)
+    for i, text in enumerate(texts):
+        try:
+            numbers = [float(number) for number in text.strip("[]").split(",")]
+        except ValueError:
+            continue
+        if len(numbers) == size:
+            vectors[i] = numbers
+    return vectors
+
+
+def order_volumes(positions: np.ndarray, orientations: np.ndarray, acquisitions: np.ndarray,
+                  instances: np.ndarray, gap_factor: float = GAP_FACTOR,
+                  tolerance: float = DUPLICATE_TOLERANCE) -> List[np.ndarray]:
+    """Split the slices of a series into 3D volumes, ordered along their normal.
+
+    Slices are grouped by orientation, and their ImagePositionPatient is
+    projected on the normal of the slices. Within a group, the k-th slice
+    found at a position, by AcquisitionNumber then InstanceNumber, goes to
+    the k-th volume, and a volume is cut where the step between two slices
+    is larger than gap_factor times its median spacing. So acquisitions
+    side by side, down to one per slice, make one volume, and overlapping
+    ones make several.
+
+    Parameters
+    ----------
+    positions : np.ndarray
+        (n, 3) ImagePositionPatient of the slices
+    orientations : np.ndarray
+        (n, 6) ImageOrientationPatient, NaN rows are taken as axial
+    acquisitions, instances : np.ndarray
+        (n,) AcquisitionNumber and InstanceNumber, NaN when missing
+
+    Returns
+    -------
+    List[np.ndarray]
+        The indices of the slices of each volume, in order.
+    """
+    orientations = np.where(np.isnan(orientations), AXIAL, orientations)
+    instances = np.nan_to_num(instances, nan=0.0)
+    acquisitions = np.nan_to_num(acquisitions, nan=-1.0)
+    keys = np.round(orientations, 4)
+    if (keys == keys[0]).all():
+        groups = np.zeros(len(keys), dtype=int)
+    else:
+        _, groups = np.unique(keys, axis=0, return_inverse=True)
+        groups = groups.reshape(-1)
+    volumes = []
+    for group in range(groups.max() + 1):
+        indices = np.flatnonzero(groups == group)
+        normal = np.cross(orientations[indices[0], :3], orientations[indices[0], 3:])
+        z = positions[indices] @ normal
+        if np.isnan(z).any():
+            # can not be placed in space, keep the acquisition and InstanceNumber order
+            volumes.append(indices[np.lexsort((instances[indices], acquisitions[indices]))])
+            continue
+        order = np.lexsort((instances[indices], acquisitions[indices], z))
+        indices, z = indices[order], z[order]
+        starts = np.flatnonzero(np.r_[True, np.diff(z) > tolerance])
+        rank = np.arange(len(z)) - np.repeat(starts, np.diff(np.r_[starts, len(z)]))
+        for repeat in range(rank.max() + 1):
+            volume, volume_z = indices[rank == repeat], z[rank == repeat]
+            steps = np.diff(volume_z)
+            if len(steps):
+                volumes.extend(np.split(volume, np.flatnonzero(steps > gap_factor * np.median(steps)) + 1))
+            else:
+                volumes.append(volume)
+    return volumes
+
+
+def _geometry(table: pd.DataFrame) -> Tuple[np.ndarray, ...]:
+    columns = {key: table[key] if key in table else pd.Series(np.nan, index=table.index) for key in GEOMETRY_KEYS}
+    return (_vectors(columns["ImagePositionPatient"], 3), _vectors(columns["ImageOrientationPatient"], 6),
+            pd.to_numeric(columns["AcquisitionNumber"], errors="coerce").to_numpy(dtype=float),
+            pd.to_numeric(columns["InstanceNumber"], errors="coerce").to_numpy(dtype=float))
+
+
+def locations_of(table: pd.DataFrame) -> np.ndarray:
+    """Path of the file of each slice, archive::member for the slices of zip archives."""
+    locations = table["file_location"] if "file_location" in table else pd.Series(np.nan, index=table.index)
+    if "member" in table:
+        in_archive = table["member"].notna()
+        locations = locations.where(~in_archive, table["archive"] + MEMBER_SEPARATOR + table["member"])
+    return locations.to_numpy()
 
 
-# TODO
+def volume_rows(table: pd.DataFrame,
+                geometry: Optional[Tuple[np.ndarray, ...]] = None) -> Iterator[Tuple[str, np.ndarray]]:
+    """(SeriesInstanceUID, ordered row positions) of each volume of a metadata table, series by series."""
+    geometry = _geometry(table) if geometry is None else geometry
+    series_uids = table["SeriesInstanceUID"].str.strip("'")  # repr of the UIDs in metadatas.csv
+    for series_uid, rows in series_uids.groupby(series_uids, sort=False).indices.items():
+        for volume in order_volumes(*(values[rows] for values in geometry)):
+            yield series_uid, rows[volume]
 
-def group_by_correct_volumes(slices_mdatas):
-    """Correctly group slices to obtain 3D volume.
 
-    More specifically, the following thing can happened (have happened to me...):
-    * different Acquisition number, but same volume
-    * more to come...
+def read_db(db: pathlib.Path) -> pd.DataFrame:
+    """The columns of metadatas.csv or metadatas.parquet needed to plan the conversion.
 
-    So, need to check both z-location (from ImagePositionPatient tag), instanceNumber and acquisition number
-    to have a proper 3D volume
+    The row column gives the position of each slice in the file.
     """
+    columns = [*ID_KEYS, "file_location", "archive", "member", *GEOMETRY_KEYS, "PixelSpacing"]
+    if db.suffix == ".parquet":
+        table = pd.read_parquet(db, columns=columns)
+    else:
+        table = pd.read_csv(db, usecols=lambda column: column in columns)
+    return table.rename_axis("row").reset_index()
 
-    # start from a list of flat dict
-    new_by_inst_nb = sorted(slices_mdatas, key=operator.itemgetter("AcquisitionNumber", "InstanceNumber"))
-    new_by_zloc = sorted(slices_mdatas, key=operator.itemgetter("AcquisitionNumber", "InstanceNumber"))
-    if not new_by_zloc == new_by_inst_nb:
-        print("discrepancy in slice order between z position and instance number!")
-        print("Using zloc to discriminate slice")
 
+if __name__ == '__main__':
+    logging.basicConfig(format="%(message)s")
+    log.setLevel(logging.INFO)  # the progress, not the messages of the other modules
+    main()
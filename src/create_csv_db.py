@@ -2,16 +2,26 @@
 """
 import argparse
 import collections
-from collections.abc import MutableMapping
+import itertools
+import zipfile
+from contextlib import nullcontext
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Dict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
-import pandas as pd
 import pydicom as dicom
 from joblib import Parallel, delayed
+from pydicom.datadict import tag_for_keyword
+from pydicom.filereader import read_partial
+from pydicom.tag import BaseTag
 
-from src.dicom_keys import DICOM_TAGS_TO_KEEP
-from src.filters import keep_slice, small_series
+from src.dicom_keys import DICOM_TAGS_TO_KEEP, SEQUENCE_KEY
+from src.filters import (CorrectedImage, ImageType, Modality, SeriesDescription, keep_slice, keep_slices,
+                         small_series)
+from src.metadata_index import MEMBER_SEPARATOR, MetadataIndex, index_path
+from src.record_store import ColumnTypes, SliceStore
+from src.series_index import SeriesIndexWriter, series_index_path
+from src.stage_profile import RunProfile, count, profiled, stage, timed_iter
 
 parser = argparse.ArgumentParser()
 parser.add_argument("source", help="the root folder where to recursively search and analyse dicom filess")
@@ -19,29 +29,22 @@ parser.add_argument("--jobs", "-j", help="Number of workers to use", default=4,
 parser.add_argument("--filter_small_series", help="filter series with less than 25 slices in it", action="store_true")
 parser.add_argument("--filter_slices", help="keep only CT,MR,AC PT,RTSTRUC and SEG, original acquisition only",
                     action="store_true")
+parser.add_argument("--incremental", help="only parse the files added or modified since the last run, using an "
+                                          "index saved in the source folder", action="store_true")
+parser.add_argument("--archives", help="also index the dicom files inside the zip archives of the source folder, "
+                                      "without extracting them", action="store_true")
+parser.add_argument("--profile", help="print the time spent in each stage, the throughput and the load of each "
+                                     "worker at the end", action="store_true")
+parser.add_argument("--profile_dir", help="with --profile, dump the cProfile stats of each worker in this folder")
+parser.add_argument("--format", help="metadatas.csv, or metadatas.parquet with typed columns", default="csv",
+                    choices=("csv", "parquet"))
 
 dicom.config.datetime_conversion = True
 
-
-def dicom_dataset_to_flat_dict(dicom_header):
-    dicom_dict = {}
-    repr(dicom_header)
-    for dicom_value in dicom_header.values():
-        if dicom_value.tag == (0x7fe0, 0x0010):
-            # discard pixel data
-            continue
-        if isinstance(dicom_value.value, dicom.dataset.Dataset):
-            dicom_dict[dicom_value.keyword] = dicom_dataset_to_flat_dict(dicom_value.value)
-        elif isinstance(dicom_value.value, dicom.sequence.Sequence):
-            for i, dataset in enumerate(dicom_value.value):
-                dicom_dict[dicom_value.keyword + str(i)] = dicom_dataset_to_flat_dict(dataset)
-        else:
-            v = _convert_value(dicom_value.value)
-            dicom_dict[dicom_value.keyword] = v
-        # add a z_location key for later use
-        if hasattr(dicom_dict, "ImagePositionPatient"):
-            dicom_dict["z_location"] = dicom_header.ImagePositionPatient[-1]
-    return flatten(dicom_dict)
+# files parsed by each worker task
+BATCH_SIZE = 256
+# rows of metadatas.csv written at once
+CSV_CHUNK_SIZE = 10_000
 
 
 def _sanitise_unicode(s):
@@ -70,57 +73,291 @@ def _convert_value(v):
     return cv
 
 
-def flatten(d, parent_key='', sep='_'):
-    """https://stackoverflow.com/a/6027615
+def _typed_value(v):
+    """Like _convert_value, keeping multi-valued elements as lists and UIDs as plain strings."""
+    if isinstance(v, dicom.multival.MultiValue):
+        return [_typed_value(x) for x in v]
+    if isinstance(v, dicom.uid.UID):
+        return str(v)
+    return _convert_value(v)
+
+
+@dataclass
+class TagPlan:
+    """What to read from a dicom header to get a list of flat keys.
+
+    keywords are the top level elements to keep, and sequences maps a
+    sequence keyword to the keywords to keep in each of its items, by item
+    index (flat keys like RadiopharmaceuticalInformationSequence0_Radiopharmaceutical).
     """
-    items = []
-    for k, v in d.items():
-        new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, MutableMapping):
-            items.extend(flatten(v, new_key, sep=sep).items())
-        else:
-            items.append((new_key, v))
-    return dict(items)
+    keywords: Set[str]
+    sequences: Dict[str, Dict[int, Set[str]]]
+    tags: List[BaseTag]
+
+    def stop_when(self, tag: BaseTag, vr: Optional[str], length: int) -> bool:
+        # elements are sorted by tag, nothing needed after the last one
+        return tag > self.tags[-1]
+
+
+def compile_tag_plan(keys: Iterable[str]) -> TagPlan:
+    """Translate flat keys, a keyword or Sequence<index>_Keyword as in DICOM_TAGS_TO_KEEP, to a TagPlan."""
+    keywords = set()
+    sequences = collections.defaultdict(lambda: collections.defaultdict(set))
+    for key in keys:
+        match = SEQUENCE_KEY.fullmatch(key)
+        if match is not None and tag_for_keyword(match["sequence"]) is not None:
+            sequences[match["sequence"]][int(match["index"])].add(match["keyword"])
+        elif tag_for_keyword(key) is not None:
+            keywords.add(key)
+    tags = sorted(BaseTag(tag_for_keyword(keyword)) for keyword in keywords | set(sequences))
+    return TagPlan(keywords, {sequence: dict(items) for sequence, items in sequences.items()}, tags)
 
 
-def dcm_file_to_flat_dict(file):
-    print(f"Working on {file}")
-    with dicom.dcmread(str(file), stop_before_pixels=True) as ds:
-        extract = dicom_dataset_to_flat_dict(ds)
-        m_datas = {key: value for key, value in extract.items() if key in DICOM_TAGS_TO_KEEP}
-        m_datas["file_location"] = str(file.resolve())
-    return m_datas
+TAG_PLAN = compile_tag_plan(DICOM_TAGS_TO_KEEP)
+# the elements keep_slice looks at, read first to skip the rest of the rejected slices
+FILTER_PLAN = compile_tag_plan([Modality, ImageType, CorrectedImage, SeriesDescription])
 
 
-def merge_series(list_of_metas: List[Dict]) -> Dict:
-    """Merge series with the same SeriesUID.
+def read_header(file, tag_plan: TagPlan = TAG_PLAN) -> dicom.Dataset:
+    """Read only the elements of the plan, stopping after the last one.
+
+    file is a path or a binary file object, like a zip archive member.
     """
-    result = collections.defaultdict(list)
-    for metas in list_of_metas:
-            result[metas["SeriesInstanceUID"]].append(metas)
-    return result
+    if not hasattr(file, "read"):
+        with open(file, "rb") as fileobj:
+            return read_header(fileobj, tag_plan)
+    return read_partial(file, stop_when=tag_plan.stop_when, specific_tags=tag_plan.tags)
 
 
-def extract_dcm_metadata_to_csv(folder: Path, n_jobs, filter_slice=True, filter_series=True):
-    folder = folder.expanduser().resolve()
-    files = folder.rglob("*.dcm")
-    with Parallel(n_jobs=n_jobs) as parallel:
-        list_of_metadata_dict = parallel(delayed(dcm_file_to_flat_dict)(file) for file in files)
+def header_to_flat_dict(dicom_header: dicom.Dataset, tag_plan: TagPlan = TAG_PLAN,
+                        convert: Callable = _convert_value) -> Dict:
+    """Flat dict of the elements of a dicom header that are in the plan.
+
+    The elements of sequence items get keys like
+    RadiopharmaceuticalInformationSequence0_Radiopharmaceutical. Values are
+    converted by _convert_value, or by another convert function like
+    _typed_value.
+    """
+    dicom_dict = {}
+    for dicom_value in dicom_header:
+        keyword = dicom_value.keyword
+        if dicom_value.VR == "SQ":
+            items = tag_plan.sequences.get(keyword, {})
+            for i, dataset in enumerate(dicom_value.value):
+                for nested_value in dataset:
+                    if nested_value.keyword in items.get(i, ()) and nested_value.VR != "SQ":
+                        dicom_dict[f"{keyword}{i}_{nested_value.keyword}"] = convert(nested_value.value)
+        elif keyword in tag_plan.keywords:
+            dicom_dict[keyword] = convert(dicom_value.value)
+    return dicom_dict
+
+
+def parse_header(fileobj, typed=False, filter_slice=False) -> Optional[Dict]:
+    """Flat dict of the kept elements of a dicom file object, None if keep_slice rejects it.
+
+    With filter_slice, the elements of FILTER_PLAN are probed first, and
+    the header is read again with TAG_PLAN only for the slices kept.
+    """
+    convert = _typed_value if typed else _convert_value
+    try:
         if filter_slice:
-            indexer = parallel(delayed(keep_slice)(slice_) for slice_ in list_of_metadata_dict)
-            list_of_metadata_dict = [x for x, y in zip(list_of_metadata_dict, indexer) if y]
-    metadatas_group_by_series_acq_number = merge_series(list_of_metadata_dict)
-    final_list_of_mdatas = []
-    for unique_series, series_slices in metadatas_group_by_series_acq_number.items():
-        if filter_series and small_series(series_slices):
-            continue
+            with stage("probe"):
+                kept = keep_slice(header_to_flat_dict(read_header(fileobj, FILTER_PLAN), FILTER_PLAN, convert))
+            if not kept:
+                return None
+            fileobj.seek(0)
+        with stage("read"):
+            dicom_header = read_header(fileobj)
+        with stage("convert"):
+            return header_to_flat_dict(dicom_header, convert=convert)
+    finally:
+        count(1, fileobj.tell())
+
+
+def parse_files(files: List[Path], typed=False, filter_slice=False) -> List[Dict]:
+    """Worker task: the headers of a batch of files, without the slices filtered out."""
+    records = []
+    for file in files:
+        file = Path(file)
+        with stage("open"):
+            fileobj = open(file, "rb")
+        with fileobj:
+            m_datas = parse_header(fileobj, typed, filter_slice)
+        if m_datas is not None:
+            m_datas["file_location"] = str(file.resolve())
+            records.append(m_datas)
+    return records
+
+
+def dicom_members(archive: zipfile.ZipFile) -> List[str]:
+    return [name for name in archive.namelist() if name.endswith(".dcm")]
+
+
+def parse_archive(archive: Path, members: Optional[List[str]] = None, typed=False, filter_slice=False) -> List[Dict]:
+    """Worker task: the headers of the dicom files of a zip archive, read without extracting them.
+
+    Each record gives the archive and member instead of a file_location.
+    Only the given members are read, all the dicom files by default.
+    """
+    archive = Path(archive).resolve()
+    records = []
+    with zipfile.ZipFile(archive) as zip_archive:
+        for member in dicom_members(zip_archive) if members is None else members:
+            with zip_archive.open(member) as fileobj:
+                m_datas = parse_header(fileobj, typed, filter_slice)
+            if m_datas is not None:
+                m_datas["archive"] = str(archive)
+                m_datas["member"] = member
+                records.append(m_datas)
+    return records
+
+
+def _task(function: Callable, *args, run_profile: Optional[RunProfile] = None):
+    """A joblib task, run through profiled when profiling."""
+    if run_profile is None:
+        return delayed(function)(*args)
+    profile_dir = None if run_profile.profile_dir is None else str(run_profile.profile_dir)
+    return delayed(profiled)(function, *args, profile_dir=profile_dir)
+
+
+def _results(results: Iterable, run_profile: Optional[RunProfile] = None) -> Iterable:
+    return results if run_profile is None else run_profile.results(results)
+
+
+def batched(iterable: Iterable, size: int = BATCH_SIZE) -> Iterator[List]:
+    iterator = iter(iterable)
+    return iter(lambda: list(itertools.islice(iterator, size)), [])
+
+
+def list_dcm_files(folder: Path) -> Iterator[Tuple[str, int, int]]:
+    """(path, size, mtime_ns) of every .dcm file in folder."""
+    for file in folder.rglob("*.dcm"):
+        stat = file.stat()
+        yield str(file), stat.st_size, stat.st_mtime_ns
+
+
+def list_archives(folder: Path) -> Iterator[Path]:
+    """The zip archives of folder, whatever their extension, as tcia_dl saves them without one."""
+    for file in folder.rglob("*"):
+        if file.suffix != ".dcm" and file.is_file() and zipfile.is_zipfile(file):
+            yield file
+
+
+def list_archive_members(folder: Path) -> Iterator[Tuple[str, int, int]]:
+    """(archive::member, size, mtime_ns) of the dicom files in the zip archives of folder.
+
+    Members get the size and modification time of their archive.
+    """
+    for file in list_archives(folder):
+        stat = file.stat()
+        with zipfile.ZipFile(file) as archive:
+            for member in dicom_members(archive):
+                yield f"{file}{MEMBER_SEPARATOR}{member}", stat.st_size, stat.st_mtime_ns
+
+
+def _index_tasks(stale: List[Tuple[str, int, int]], typed=False,
+                 run_profile: Optional[RunProfile] = None) -> Iterator[Tuple[List, Callable]]:
+    """Split the entries to parse into worker tasks: batches of files, and one task by archive."""
+    files = []
+    members = collections.defaultdict(list)
+    for entry in stale:
+        archive, separator, member = entry[0].partition(MEMBER_SEPARATOR)
+        if separator:
+            members[archive].append((entry, member))
         else:
-            final_list_of_mdatas.extend(series_slices)
-    df = pd.DataFrame.from_records(final_list_of_mdatas)
-    df.to_csv(folder / "metadatas.csv", index=False)
+            files.append(entry)
+    for batch in batched(files):
+        yield batch, _task(parse_files, [path for path, _, _ in batch], typed, run_profile=run_profile)
+    for archive, entries in members.items():
+        yield [entry for entry, _ in entries], _task(parse_archive, archive, [member for _, member in entries], typed,
+                                                     run_profile=run_profile)
+
+
+def update_index(folder: Path, parallel: Parallel, typed=False, archives=False,
+                 run_profile: Optional[RunProfile] = None) -> Iterator[Dict]:
+    """Parse the new or modified files of folder, and yield all the indexed headers.
+
+    parallel must return its results as a generator.
+    """
+    with MetadataIndex(index_path(folder, typed)) as index:
+        listing = list_dcm_files(folder)
+        if archives:
+            listing = itertools.chain(listing, list_archive_members(folder))
+        stale, removed = index.update_listing(timed_iter(listing, "walk"))
+        print(f"{len(stale)} new or modified files, {removed} removed files")
+        batches, tasks = zip(*_index_tasks(stale, typed, run_profile)) if stale else ((), ())
+        results = _results(parallel(tasks), run_profile)
+        for records, batch in zip(results, batches):  # results first, to exhaust the generator
+            with stage("store"):
+                index.store((path, size, mtime_ns, record) for (path, size, mtime_ns), record in zip(batch, records))
+        yield from index.records()
+
+
+def extract_dcm_metadata_to_csv(folder: Path, n_jobs, filter_slice=True, filter_series=True, incremental=False,
+                                output_format="csv", archives=False, profile=False, profile_dir=None):
+    folder = folder.expanduser().resolve()
+    run_profile = RunProfile(None if profile_dir is None else Path(profile_dir).expanduser()) if profile else None
+    with run_profile or nullcontext():
+        _extract_dcm_metadata(folder, n_jobs, filter_slice, filter_series, incremental, output_format, archives,
+                              run_profile)
+    if run_profile is not None:
+        print(run_profile.summary())
+
+
+def _extract_dcm_metadata(folder, n_jobs, filter_slice, filter_series, incremental, output_format, archives,
+                          run_profile):
+    typed = output_format == "parquet"
+    with SliceStore(folder) as store:
+        with stage("parse"), Parallel(n_jobs=n_jobs, return_as="generator") as parallel:
+            if incremental:
+                # the index keeps every header, whatever the filters of this run
+                list_of_metadata_dict = update_index(folder, parallel, typed, archives, run_profile)
+                batches = batched(list_of_metadata_dict)
+                if filter_slice:
+                    # a table of the indexed headers at a time, instead of keep_slice on each of them
+                    batches = map(keep_slices, batched(list_of_metadata_dict, CSV_CHUNK_SIZE))
+            else:
+                files = timed_iter(folder.rglob("*.dcm"), "walk")
+                tasks = (_task(parse_files, batch, typed, filter_slice, run_profile=run_profile)
+                         for batch in batched(files))
+                if archives:
+                    tasks = itertools.chain(tasks, (_task(parse_archive, archive, None, typed, filter_slice,
+                                                          run_profile=run_profile)
+                                                    for archive in timed_iter(list_archives(folder), "walk")))
+                batches = _results(parallel(tasks), run_profile)
+            for records in batches:
+                with stage("spill"):
+                    store.add(records)
+        with stage("series"):
+            kept_series = set()
+            column_types = ColumnTypes()
+            for series_id, series_slices in store.series():
+                if filter_series and small_series(series_slices):
+                    continue
+                kept_series.add(series_id)
+                column_types.add(series_slices)
+        with stage("write"), SeriesIndexWriter(series_index_path(folder)) as series_index:
+            final_series = (slices for series_id, slices in store.series() if series_id in kept_series)
+            if typed:
+                from src.parquet_io import write_parquet  # pyarrow is only needed for this format
+                write_parquet(_indexed(final_series, series_index), folder / "metadatas.parquet")
+                return
+            with open(folder / "metadatas.csv", "w", newline="") as csv_file:
+                column_types.frame([]).to_csv(csv_file, index=False)
+                for chunk in batched(_indexed(final_series, series_index), CSV_CHUNK_SIZE):
+                    column_types.frame(chunk).to_csv(csv_file, index=False, header=False)
+
+
+def _indexed(series: Iterable[List[Dict]], series_index: SeriesIndexWriter) -> Iterator[Dict]:
+    """The slices of each series, adding the series to the index on the way."""
+    for series_slices in series:
+        series_index.add(series_slices)
+        yield from series_slices
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
     print(args)
-    extract_dcm_metadata_to_csv(Path(args.source), args.jobs, args.filter_slices, args.filter_small_series)
+    extract_dcm_metadata_to_csv(Path(args.source), args.jobs, args.filter_slices, args.filter_small_series,
+                                args.incremental, args.format, args.archives, args.profile or bool(args.profile_dir),
+                                args.profile_dir)
@@ -1,3 +1,5 @@
+import re
+
 DICOM_TAGS_TO_KEEP = ['AccessionNumber', 'AcquisitionDate',
                       'AcquisitionDateTime', 'AcquisitionNumber', 'AcquisitionTime',
                       'AttenuationCorrectionMethod', 'BodyPartExamined',
@@ -60,4 +62,8 @@ DICOM_TAGS_TO_KEEP = ['AccessionNumber', 'AcquisitionDate',
                       'SpacingBetweenSlices',
                       'StudyDate',
                       'StudyDescription',
-                      'StudyID', 'StudyInstanceUID', 'StudyPriorityID', 'StudyStatusID', 'StudyTime', 'file_location']
+                      'StudyID', 'StudyInstanceUID', 'StudyPriorityID', 'StudyStatusID', 'StudyTime', 'file_location',
+                      'archive', 'member']
+
+# flat key of an element of a sequence item, like EnergyWindowRangeSequence0_EnergyWindowLowerLimit
+SEQUENCE_KEY = re.compile(r"(?P<sequence>\w+?)(?P<index>\d+)_(?P<keyword>\w+)")
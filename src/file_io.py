@@ -46,6 +46,23 @@ def is_empty(directory: pathlib.Path) -> bool:
     return not any(directory.iterdir())
 
 
+def disk_size(path: pathlib.Path) -> int:
+    """Size of a file, or of all the files in a directory, in bytes.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        A file or a directory
+
+    Returns
+    -------
+    int
+    """
+    if path.is_dir():
+        return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+    return path.stat().st_size
+
+
 def mv(old_path: pathlib.Path, new_path: pathlib.Path) -> None:
     """Move a file to the new location.
 
@@ -154,6 +171,25 @@ def ensure(path: pathlib.Path):
     return path
 
 
+def part_path(path: pathlib.Path) -> pathlib.Path:
+    """Hidden file next to path, to write path atomically with os.replace.
+
+    The extensions are kept, as writers like SimpleITK guess the format from
+    them.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        The final file
+
+    Returns
+    -------
+    pathlib.Path
+        The temporary file
+    """
+    return path.with_name(f".part.{path.name}")
+
+
 def remove_ext(filepath: pathlib.Path) -> pathlib.Path:
     """Remove file extension.
 
@@ -2,6 +2,10 @@
 
 """
 import re
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
 
 from src.dicom_keys import DICOM_TAGS_TO_KEEP
 
@@ -14,6 +18,8 @@ assert CorrectedImage in DICOM_TAGS_TO_KEEP
 assert Modality in DICOM_TAGS_TO_KEEP
 assert SeriesDescription in DICOM_TAGS_TO_KEEP
 
+NO_AC_STRINGS = ["noac", "nac", "noattn"]
+
 
 def original_image(metas):
     # specify modality in case dicom rt or seg are not original
@@ -25,14 +31,19 @@ def attn_corrected(metas):
         return True
     else:
         conds = []
-        no_ac_strings = ["noac", "nac", "noattn"]
         if CorrectedImage in metas:
             conds.append("ATTN" in metas[CorrectedImage])
-        conds.extend(
-            pattern not in re.sub(r'[^A-Za-z0-9]+', '', metas[SeriesDescription]).lower() for pattern in no_ac_strings)
+        conds.append(not no_ac_description(metas[SeriesDescription]))
         return all(conds)
 
 
+@lru_cache(maxsize=4096)
+def no_ac_description(description):
+    """Whether a SeriesDescription names a PET without attenuation correction."""
+    simplified = re.sub(r'[^A-Za-z0-9]+', '', description).lower()
+    return any(pattern in simplified for pattern in NO_AC_STRINGS)
+
+
 def is_ct_rtstruct_seg_mr_pt(metas):
     return metas[Modality] in ["RTSTRUCT", "CT", "PT", "SEG", "MR"]
 
@@ -48,3 +59,51 @@ def keep_slice(metas):
 
 def small_series(list_of_slices):
     return len(list_of_slices) < 25
+
+
+# Same filters on a whole table, e.g. pd.read_parquet("metadatas.parquet"), one row per slice.
+# Each predicate is evaluated once per distinct value of its column.
+
+def _factorize(column):
+    try:
+        return pd.factorize(column)
+    except TypeError:
+        # lists of the typed headers, e.g. ImageType read from metadatas.parquet
+        return pd.factorize(
+            pd.Series([tuple(value) if isinstance(value, (list, np.ndarray)) else value for value in column],
+                      dtype=object))
+
+
+def _map_distinct(column, predicate, missing=False):
+    """predicate of each value of column, computed once per distinct value. missing for NaN/None."""
+    codes, uniques = _factorize(column)
+    results = np.array([bool(predicate(value)) for value in uniques] + [missing])
+    return results[codes]  # code -1, the missing values, picks the last result
+
+
+def is_ct_rtstruct_seg_mr_pt_mask(table):
+    return table[Modality].isin(["RTSTRUCT", "CT", "PT", "SEG", "MR"]).to_numpy()
+
+
+def original_image_mask(table):
+    return _map_distinct(table[ImageType], lambda value: "ORIGINAL" in value) & table[Modality].isin(
+        ["CT", "PT", "MR"]).to_numpy()
+
+
+def attn_corrected_mask(table):
+    conds = ~_map_distinct(table[SeriesDescription], no_ac_description)
+    if CorrectedImage in table:
+        # slices without the element pass, as in attn_corrected
+        conds &= _map_distinct(table[CorrectedImage], lambda value: "ATTN" in value, missing=True)
+    return (table[Modality] != "PT").to_numpy() | conds
+
+
+def keep_slice_mask(table):
+    """Boolean mask of the rows keep_slice would keep."""
+    return is_ct_rtstruct_seg_mr_pt_mask(table) & original_image_mask(table) & attn_corrected_mask(table)
+
+
+def keep_slices(slices):
+    """The slices keep_slice would keep, of a list of flat dicts, filtered with keep_slice_mask."""
+    table = pd.DataFrame.from_records(slices, columns=[Modality, ImageType, CorrectedImage, SeriesDescription])
+    return [metas for metas, kept in zip(slices, keep_slice_mask(table)) if kept]
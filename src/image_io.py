@@ -1,15 +1,23 @@
 import logging
+import os
 import pathlib
-from typing import Dict, Tuple
+from typing import Dict, Optional, Sequence, Tuple
 import toml
 
 import SimpleITK as sitk
 
-from src.file_io import ensure, remove_ext
+from src.file_io import ensure, part_path
 from src.utils import get_valid_filepath
+from src.volume_formats import GZIP_LEVEL, ZARR_CHUNKS, format_of, stem_of, write_volume
+from src.volume_io import VolumeGeometry, read_volume, volume_to_image
 
 log = logging.getLogger(__name__)
 
+# how files_to_nii reads the slices: ImageSeriesReader, or src.volume_io
+SITK = "sitk"
+NUMPY = "numpy"
+BACKENDS = (SITK, NUMPY)
+
 
 data_elements = [
     ("0008|0020", "Study Date"),
@@ -155,7 +163,9 @@ def extract_all_dcm_metadata(dcm: str, reader: sitk.ImageFileReader):
 def dcm_to_nii(source: pathlib.Path, dest: pathlib.Path) -> None:
     """Convert the given .dcm files from source folder to a 3D .nii file.
 
-    This will also save the headers in a .toml file
+    This will also save the headers in a .toml file. Both files are written
+    under a temporary name first, the image last, so dest only exists once
+    the conversion is complete.
 
     Parameters
     ----------
@@ -179,13 +189,74 @@ def dcm_to_nii(source: pathlib.Path, dest: pathlib.Path) -> None:
         )
     Id = Ids[0]
     files = reader.GetGDCMSeriesFileNames(str(source), Id)
-    reader.SetFileNames(files)
-    image = reader.Execute()
-    sitk.WriteImage(image, str(ensure(dest)))
     mdata_reader = metadata_reader()
     metadata = extract_all_dcm_metadata(files[0], mdata_reader)
-    metadata_file = str(remove_ext(dest)) + ".toml"
-    with pathlib.Path(metadata_file).open("w") as metadata_file:
-        toml.dump(metadata, metadata_file)
-    log.info("%s created", str(dest))
+    files_to_nii(files, [pathlib.Path(dest)], metadata)
+
+
+def read_image(files: Sequence[str], backend: str = SITK, geometry: Optional[VolumeGeometry] = None,
+               threads: int = 1) -> sitk.Image:
+    """Read the given .dcm files of a volume, in this order, with one of the BACKENDS.
+
+    The numpy backend decodes the slices with `threads` threads and needs the
+    geometry of the volume, the sitk one reads it from the files and uses the
+    threads set by sitk.ProcessObject_SetGlobalDefaultNumberOfThreads.
+    """
+    if backend == NUMPY:
+        if geometry is None:
+            raise ValueError("the numpy backend needs the geometry of the volume")
+        return volume_to_image(read_volume(files, threads), geometry)
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames([str(file) for file in files])
+    return reader.Execute()
+
+
+def files_to_nii(files: Sequence[str], dests: Sequence[pathlib.Path], metadata: Dict, backend: str = SITK,
+                 geometry: Optional[VolumeGeometry] = None, threads: int = 1, level: int = GZIP_LEVEL,
+                 chunks: Sequence[int] = ZARR_CHUNKS) -> None:
+    """Convert the given .dcm files of a volume, in this order, to one or more 3D image files.
+
+    Unlike dcm_to_nii, no header is read to find or sort the files, they
+    come from the metadata DB (see src.conv2nii.plan_jobs), as the
+    metadata saved in the .toml file.
+
+    Parameters
+    ----------
+    files : Sequence[str]
+        The .dcm files, ordered along the slice axis
+    dests : Sequence[pathlib.Path]
+        The files to write, in the format of their extension: those of
+        src.volume_formats, else any format of sitk.WriteImage.
+    metadata : Dict
+        The headers to save next to the first of dests, with the affine of the volume
+    backend, geometry, threads
+        How the files are read, see read_image. The threads also compress
+        the .nii.gz files.
+    level, chunks
+        See src.volume_formats.write_volume
+
+    Returns
+    -------
+    None
+        Nothing.
+    """
+    if backend == NUMPY:
+        if geometry is None:
+            raise ValueError("the numpy backend needs the geometry of the volume")
+        image = None
+        volume = read_volume(files, threads)
+    else:
+        image = read_image(files)  # kept alive while its voxels are written from the view
+        volume, geometry = sitk.GetArrayViewFromImage(image), VolumeGeometry.from_image(image)
+    metadata_file = pathlib.Path(str(stem_of(dests[0])) + ".toml")
+    with part_path(ensure(metadata_file)).open("w") as part_metadata_file:
+        toml.dump({**metadata, "affine_lps": geometry.affine.tolist()}, part_metadata_file)
+    os.replace(part_path(metadata_file), metadata_file)
+    write_volume(volume, geometry, [dest for dest in dests if format_of(dest) is not None], level, threads, chunks)
+    for dest in dests:
+        if format_of(dest) is None:
+            image = volume_to_image(volume, geometry) if image is None else image
+            sitk.WriteImage(image, str(part_path(ensure(dest))))
+            os.replace(part_path(dest), dest)
+    log.info("%s created", ", ".join(str(dest) for dest in dests))
     return None
@@ -0,0 +1,152 @@
+"""On-disk record of the series downloaded for a manifest.
+
+The ledger is a SQLite database kept next to the copy of the manifest in the
+destination folder. Restarting a download only needs one query on it to know
+what is left to do, instead of checking every destination on disk.
+"""
+import pathlib
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Tuple
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    series_uid TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    size INTEGER,
+    transferred INTEGER,
+    duration REAL,
+    checksum TEXT,
+    last_error TEXT,
+    updated_at REAL,
+    expected_size INTEGER
+);
+CREATE INDEX IF NOT EXISTS series_status ON series (status);
+"""
+# columns added after the first version of the schema
+MIGRATIONS = {"expected_size": "ALTER TABLE series ADD COLUMN expected_size INTEGER"}
+
+
+def ledger_path(destination_folder: pathlib.Path, manifest: pathlib.Path) -> pathlib.Path:
+    return destination_folder / (manifest.name + ".sqlite")
+
+
+class DownloadLedger:
+    """Per-series status of a manifest download.
+
+    It is also a listener for src.scheduler.run_downloads, and must be used
+    from the thread running the scheduler only.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(series)")}
+        for column, statement in MIGRATIONS.items():
+            if column not in columns:
+                self.connection.execute(statement)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def register(self, series_uids: Iterable[str]) -> None:
+        """Add the series of the manifest, keeping the ones already known."""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO series (series_uid) VALUES (?)",
+                ((uid,) for uid in series_uids),
+            )
+
+    def todo(self) -> List[str]:
+        """Series not downloaded yet, including interrupted and failed ones."""
+        rows = self.connection.execute("SELECT series_uid FROM series WHERE status != ?", (DONE,))
+        return [uid for uid, in rows]
+
+    def expected_sizes(self) -> Dict[str, int]:
+        """Archive size of the series, when known from a previous run."""
+        rows = self.connection.execute(
+            "SELECT series_uid, expected_size FROM series WHERE expected_size IS NOT NULL"
+        )
+        return dict(rows)
+
+    def set_expected_sizes(self, sizes: Dict[str, int]) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE series SET expected_size = ? WHERE series_uid = ?",
+                ((size, uid) for uid, size in sizes.items()),
+            )
+
+    def _update(self, series_uid: str, **values) -> None:
+        values["updated_at"] = time.time()
+        columns = ", ".join(f"{column} = ?" for column in values)
+        with self.connection:
+            self.connection.execute(
+                f"UPDATE series SET {columns} WHERE series_uid = ?", (*values.values(), series_uid)
+            )
+
+    def started(self, series_uid: str) -> None:
+        with self.connection:
+            self.connection.execute(
+                "UPDATE series SET status = ?, attempts = attempts + 1, updated_at = ? WHERE series_uid = ?",
+                (RUNNING, time.time(), series_uid),
+            )
+
+    def succeeded(self, series_uid: str, result) -> None:
+        self._update(series_uid, status=DONE, size=result.size, transferred=result.transferred,
+                     duration=result.duration, checksum=result.checksum, last_error=None,
+                     expected_size=result.size)
+
+    def failed(self, series_uid: str, error: Exception, final: bool) -> None:
+        self._update(series_uid, status=FAILED if final else RUNNING, last_error=str(error))
+
+    def summary(self) -> Dict[str, Tuple[int, int]]:
+        """Number of series and bytes on disk, by status."""
+        rows = self.connection.execute(
+            "SELECT status, COUNT(*), COALESCE(SUM(size), 0) FROM series GROUP BY status"
+        )
+        return {status: (count, size) for status, count, size in rows}
+
+    def errors(self) -> List[Tuple[str, int, str]]:
+        """Series with an error, with their number of attempts and last error."""
+        rows = self.connection.execute(
+            "SELECT series_uid, attempts, last_error FROM series WHERE last_error IS NOT NULL "
+            "AND status != ? ORDER BY series_uid", (DONE,)
+        )
+        return list(rows)
+
+
+class LedgerGroup:
+    """Forward the events of each series to the ledgers of the manifests listing it.
+
+    Used when several manifests are downloaded at once, each series being
+    downloaded only once.
+    """
+
+    def __init__(self, owners: Dict[str, List[DownloadLedger]]):
+        self.owners = owners
+
+    def started(self, series_uid: str) -> None:
+        for ledger in self.owners[series_uid]:
+            ledger.started(series_uid)
+
+    def succeeded(self, series_uid: str, result) -> None:
+        for ledger in self.owners[series_uid]:
+            ledger.succeeded(series_uid, result)
+
+    def failed(self, series_uid: str, error: Exception, final: bool) -> None:
+        for ledger in self.owners[series_uid]:
+            ledger.failed(series_uid, error, final)
@@ -0,0 +1,85 @@
+"""Persistent index of the dicom headers already extracted.
+
+Each file is stored with its size and modification time, so that a new
+indexing run only parses the files added or modified since the last one.
+"""
+import json
+import pathlib
+import sqlite3
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+# index key of a member of a zip archive: <archive path>::<member name>
+MEMBER_SEPARATOR = "::"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    record TEXT NOT NULL
+);
+"""
+
+
+def index_path(folder: pathlib.Path, typed: bool = False) -> pathlib.Path:
+    """Headers converted for the csv, or typed for the parquet output, are indexed separately."""
+    return folder / ("metadatas.typed.index.sqlite" if typed else "metadatas.index.sqlite")
+
+
+class MetadataIndex:
+    """Headers of the dicom files of a folder, keyed on (path, size, mtime)."""
+
+    def __init__(self, path: pathlib.Path):
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def update_listing(self, files: Iterable[Tuple[str, int, int]]) -> Tuple[List[Tuple[str, int, int]], int]:
+        """Compare the files currently on disk with the index.
+
+        Parameters
+        ----------
+        files : Iterable[Tuple[str, int, int]]
+            (path, size, mtime_ns) of every file on disk
+
+        Returns
+        -------
+        Tuple[List[Tuple[str, int, int]], int]
+            The files to parse, as they are new or changed, and the number of
+            files removed from the index as they are not on disk anymore.
+        """
+        with self.connection:
+            self.connection.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS listing (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER)"
+            )
+            self.connection.execute("DELETE FROM listing")
+            self.connection.executemany("INSERT INTO listing VALUES (?, ?, ?)", files)
+            stale = self.connection.execute(
+                "SELECT listing.* FROM listing LEFT JOIN files ON files.path = listing.path "
+                "WHERE files.path IS NULL OR files.size != listing.size OR files.mtime_ns != listing.mtime_ns"
+            ).fetchall()
+            removed = self.connection.execute(
+                "DELETE FROM files WHERE path NOT IN (SELECT path FROM listing)"
+            ).rowcount
+        return stale, removed
+
+    def store(self, entries: Iterable[Tuple[str, int, int, Dict]]) -> None:
+        """Save (path, size, mtime_ns, record) entries."""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                ((path, size, mtime_ns, json.dumps(record)) for path, size, mtime_ns, record in entries),
+            )
+
+    def records(self) -> Iterator[Dict]:
+        for record, in self.connection.execute("SELECT record FROM files ORDER BY path"):
+            yield json.loads(record)
@@ -0,0 +1,156 @@
+"""Transfer metrics of a download run.
+
+RunMetrics listens to src.scheduler.run_downloads, prints the overall rate
+while the run goes, and writes a report at the end: one row per series in
+CSV, aggregates in JSON, and optionally a Prometheus text file (for the
+node_exporter textfile collector).
+"""
+import csv
+import json
+import math
+import os
+import pathlib
+import time
+from typing import Dict, List, Optional, Sequence
+
+PERCENTILES = (50, 90, 99)
+CSV_FIELDS = ("series_uid", "attempts", "ttfb", "duration", "transferred", "size", "throughput")
+
+
+def percentile(values: Sequence[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile, q between 0 and 100."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class RunMetrics:
+    """Collect per-series metrics and overall progress.
+
+    Parameters
+    ----------
+    total : int
+        Number of series scheduled
+    live_every : float
+        Minimum number of seconds between two progress lines
+    prometheus_file : pathlib.Path, optional
+        If given, rewritten with the current metrics along with the progress
+        lines.
+    """
+
+    def __init__(self, total: int, live_every: float = 30.0,
+                 prometheus_file: Optional[pathlib.Path] = None):
+        self.total = total
+        self.live_every = live_every
+        self.prometheus_file = prometheus_file
+        self.start = time.monotonic()
+        self.rows: List[Dict] = []
+        self.attempts: Dict[str, int] = {}
+        self.failures: Dict[str, str] = {}
+        self.retries = 0
+        self.transferred = 0
+        self._last_print = self.start
+
+    def started(self, series_uid: str) -> None:
+        self.attempts[series_uid] = self.attempts.get(series_uid, 0) + 1
+
+    def failed(self, series_uid: str, error: Exception, final: bool) -> None:
+        if final:
+            self.failures[series_uid] = str(error)
+        else:
+            self.retries += 1
+        self._progress()
+
+    def succeeded(self, series_uid: str, result) -> None:
+        self.rows.append({
+            "series_uid": series_uid,
+            "attempts": self.attempts.get(series_uid, 1),
+            "ttfb": result.ttfb,
+            "duration": result.duration,
+            "transferred": result.transferred,
+            "size": result.size,
+            "throughput": result.transferred / result.duration if result.duration else None,
+        })
+        self.transferred += result.transferred
+        self._progress()
+
+    def _progress(self) -> None:
+        now = time.monotonic()
+        if now - self._last_print < self.live_every:
+            return
+        self._last_print = now
+        done = len(self.rows) + len(self.failures)
+        print(f"[{done}/{self.total}] {self.transferred / 1e9:.2f} GB at "
+              f"{self.transferred / (now - self.start) / 1e6:.1f} MB/s, {self.retries} retries, "
+              f"{len(self.failures)} failures")
+        if self.prometheus_file is not None:
+            self.write_prometheus(self.prometheus_file)
+
+    def summary(self) -> Dict:
+        elapsed = time.monotonic() - self.start
+        downloaded = [row for row in self.rows if row["transferred"]]
+        summary = {
+            "series": self.total,
+            "succeeded": len(self.rows),
+            "downloaded": len(downloaded),
+            "failed": len(self.failures),
+            "retries": self.retries,
+            "elapsed": elapsed,
+            "transferred": self.transferred,
+            "rate": self.transferred / elapsed if elapsed else None,
+        }
+        for metric in ("ttfb", "duration", "throughput"):
+            values = [row[metric] for row in downloaded if row[metric] is not None]
+            for q in PERCENTILES:
+                summary[f"{metric}_p{q}"] = percentile(values, q)
+        summary["failures"] = self.failures
+        return summary
+
+    def write_csv(self, path: pathlib.Path) -> None:
+        with path.open("w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+    def write_json(self, path: pathlib.Path) -> None:
+        with path.open("w") as file:
+            json.dump(self.summary(), file, indent=2)
+
+    def write_prometheus(self, path: pathlib.Path) -> None:
+        """Write the metrics in the Prometheus text format, atomically."""
+        summary = self.summary()
+        lines = [
+            "# TYPE tcia_series_total gauge",
+            f"tcia_series_total {summary['series']}",
+            "# TYPE tcia_series_done gauge",
+            f"tcia_series_done{{status=\"succeeded\"}} {summary['succeeded']}",
+            f"tcia_series_done{{status=\"failed\"}} {summary['failed']}",
+            "# TYPE tcia_retries_total counter",
+            f"tcia_retries_total {summary['retries']}",
+            "# TYPE tcia_transferred_bytes_total counter",
+            f"tcia_transferred_bytes_total {summary['transferred']}",
+            "# TYPE tcia_rate_bytes_per_second gauge",
+            f"tcia_rate_bytes_per_second {summary['rate'] or 0}",
+        ]
+        for metric, unit in (("ttfb", "seconds"), ("duration", "seconds"), ("throughput", "bytes_per_second")):
+            name = f"tcia_series_{metric}_{unit}"
+            lines.append(f"# TYPE {name} summary")
+            lines.extend(f"{name}{{quantile=\"{q / 100}\"}} {summary[f'{metric}_p{q}'] or 0}" for q in PERCENTILES)
+        part = path.with_name(path.name + ".part")
+        part.write_text("\n".join(lines) + "\n")
+        os.replace(part, path)
+
+    def print_summary(self) -> None:
+        summary = self.summary()
+        print(f"{summary['succeeded']}/{summary['series']} series in {summary['elapsed']:.0f}s, "
+              f"{summary['transferred'] / 1e9:.2f} GB at {(summary['rate'] or 0) / 1e6:.1f} MB/s, "
+              f"{summary['retries']} retries, {summary['failed']} failures")
+        for metric, scale, unit in (("ttfb", 1, "s"), ("duration", 1, "s"), ("throughput", 1e6, "MB/s")):
+            values = ", ".join(
+                f"p{q} {summary[f'{metric}_p{q}'] / scale:.2f}" for q in PERCENTILES
+                if summary[f"{metric}_p{q}"] is not None
+            )
+            if values:
+                print(f"{metric:>10} ({unit}): {values}")
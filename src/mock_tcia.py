@@ -0,0 +1,181 @@
+"""Local stand-in for the TCIA getImage and getSeriesSize services.
+
+Each SeriesInstanceUID is answered with a synthetic zip of random slices,
+always the same for a given UID, with the metadata header tcia_dl expects.
+Latency, a per-connection bandwidth cap and faults can be configured, to
+measure and test the downloader offline:
+
+python -m src.mock_tcia --port 8000 --latency 0.2 --bandwidth 20M --error-rate 0.05
+python -m src.tcia download manifest.tcia /tmp/dl --endpoint http://127.0.0.1:8000/getImage
+"""
+import argparse
+import io
+import json
+import random
+import re
+import threading
+import time
+import zipfile
+import zlib
+from dataclasses import dataclass
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+from src.cache import parse_size
+
+METADATA = json.dumps({"Result": {"Type": ["ZIP"]}})
+SEND_SIZE = 64 * 1024
+
+parser = argparse.ArgumentParser("serve synthetic series like the TCIA getImage service")
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", help="0 picks a free port", type=int, default=8000)
+parser.add_argument("--slices", help="mean number of slices per series", type=int, default=100)
+parser.add_argument("--slice-size", help="size of each slice, e.g. 512K", default="512K")
+parser.add_argument("--size-spread", help="the number of slices varies from 1 to 1 + this factor times the mean",
+                    type=float, default=0.0)
+parser.add_argument("--deflate", help="compress the slices in the zip", action="store_true")
+parser.add_argument("--latency", help="seconds before answering", type=float, default=0.0)
+parser.add_argument("--bandwidth", help="maximum rate of each connection, e.g. 10M (bytes/s)")
+parser.add_argument("--error-rate", help="probability to answer 503", type=float, default=0.0)
+parser.add_argument("--throttle-rate", help="probability to answer 429 with Retry-After", type=float, default=0.0)
+parser.add_argument("--drop-rate", help="probability to close the connection in the middle of the body",
+                    type=float, default=0.0)
+parser.add_argument("--no-range", help="ignore Range headers", action="store_true")
+
+
+@dataclass
+class MockConfig:
+    slices: int = 100
+    slice_size: int = 512 * 1024
+    size_spread: float = 0.0
+    deflate: bool = False
+    latency: float = 0.0
+    bandwidth: Optional[int] = None
+    error_rate: float = 0.0
+    throttle_rate: float = 0.0
+    drop_rate: float = 0.0
+    range_support: bool = True
+
+
+@lru_cache(maxsize=32)
+def series_zip(series_uid: str, slices: int, slice_size: int, size_spread: float, deflate: bool) -> bytes:
+    """The synthetic archive of a series."""
+    rng = random.Random(zlib.crc32(series_uid.encode()))
+    count = max(1, round(slices * (1 + size_spread * rng.random())))
+    buffer = io.BytesIO()
+    method = zipfile.ZIP_DEFLATED if deflate else zipfile.ZIP_STORED
+    half = slice_size // 2
+    with zipfile.ZipFile(buffer, "w", method) as archive:
+        for instance in range(count):
+            # half random, half zeros so that deflate has something to do (rng.randbytes needs python 3.9)
+            data = rng.getrandbits(8 * half).to_bytes(half, "little") if half else b""
+            archive.writestr(f"{series_uid}/{instance:06d}.dcm", data.ljust(slice_size, b"\0"))
+    return buffer.getvalue()
+
+
+def make_handler(config: MockConfig):
+    class MockTCIAHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, as the real service
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            series_uid = parse_qs(url.query).get("SeriesInstanceUID", [None])[0]
+            if series_uid is None or not url.path.endswith(("/getImage", "/getSeriesSize")):
+                self._send_status(404)
+                return
+            if url.path.endswith("/getSeriesSize"):
+                self._send_size(series_uid)
+                return
+            time.sleep(config.latency)
+            draw = random.random()
+            if draw < config.throttle_rate:
+                self._send_status(429, {"Retry-After": "1"})
+                return
+            if draw < config.throttle_rate + config.error_rate:
+                self._send_status(503)
+                return
+            body = series_zip(series_uid, config.slices, config.slice_size, config.size_spread, config.deflate)
+            start = 0
+            match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+            if match is not None and config.range_support:
+                start = int(match.group(1))
+                if start >= len(body):
+                    self._send_status(416, {"Content-Range": f"bytes */{len(body)}"})
+                    return
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+            else:
+                self.send_response(200)
+            self.send_header("metadata", METADATA)
+            self.send_header("Content-Type", "application/zip")
+            self.send_header("Accept-Ranges", "bytes" if config.range_support else "none")
+            self.send_header("Content-Length", str(len(body) - start))
+            self.end_headers()
+            self._send_body(memoryview(body)[start:])
+
+        def _send_size(self, series_uid: str):
+            body = series_zip(series_uid, config.slices, config.slice_size, config.size_spread, config.deflate)
+            answer = json.dumps([{"TotalSizeInBytes": str(len(body)), "ObjectCount": "0"}]).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(answer)))
+            self.end_headers()
+            self.wfile.write(answer)
+
+        def _send_status(self, status: int, headers: Optional[dict] = None):
+            self.send_response(status)
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def _send_body(self, body: memoryview):
+            drop_at = len(body) // 2 if random.random() < config.drop_rate else None
+            start = time.monotonic()
+            for offset in range(0, len(body), SEND_SIZE):
+                if drop_at is not None and offset >= drop_at:
+                    self.close_connection = True
+                    return
+                self.wfile.write(body[offset:offset + SEND_SIZE])
+                if config.bandwidth:
+                    ahead = (offset + SEND_SIZE) / config.bandwidth - (time.monotonic() - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+        def log_message(self, *args):
+            pass
+
+    return MockTCIAHandler
+
+
+def serve(config: MockConfig, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Start a mock server in a background thread. Stop it with shutdown()."""
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def config_from_args(args) -> MockConfig:
+    return MockConfig(
+        slices=args.slices,
+        slice_size=parse_size(args.slice_size),
+        size_spread=args.size_spread,
+        deflate=args.deflate,
+        latency=args.latency,
+        bandwidth=parse_size(args.bandwidth) if args.bandwidth else None,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        drop_rate=args.drop_rate,
+        range_support=not args.no_range,
+    )
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(config_from_args(args)))
+    server.daemon_threads = True
+    print(f"serving on http://{args.host}:{server.server_port}/getImage", flush=True)
+    server.serve_forever()
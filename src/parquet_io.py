@@ -0,0 +1,101 @@
+"""Typed, columnar copy of the metadata DB.
+
+The schema is derived from DICOM_TAGS_TO_KEEP and the VR/VM of each keyword
+in the pydicom data dictionary: multi-valued elements like
+ImagePositionPatient are stored as lists of floats instead of strings. Rows
+are written by row groups, and any subset of columns can be read back:
+
+pd.read_parquet("metadatas.parquet", columns=["SeriesInstanceUID", "ImagePositionPatient"])
+"""
+import itertools
+import pathlib
+from typing import Dict, Iterable, List
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pydicom.datadict import dictionary_VM, dictionary_VR, tag_for_keyword
+
+from src.dicom_keys import DICOM_TAGS_TO_KEEP, SEQUENCE_KEY
+
+FLOAT_VRS = {"DS", "FL", "FD", "OF", "OD"}
+INTEGER_VRS = {"IS", "SS", "US", "SL", "UL", "SV", "UV", "US or SS"}
+ROW_GROUP_SIZE = 50_000
+
+
+def _keyword_of(key: str) -> str:
+    match = SEQUENCE_KEY.fullmatch(key)
+    if match is not None and tag_for_keyword(match["sequence"]) is not None:
+        return match["keyword"]
+    return key
+
+
+def arrow_type(key: str) -> pa.DataType:
+    """Arrow type of a flat key, from the data dictionary. Unknown keys are strings."""
+    keyword = _keyword_of(key)
+    if tag_for_keyword(keyword) is None:
+        return pa.string()
+    vr, vm = dictionary_VR(keyword), dictionary_VM(keyword)
+    if vr in FLOAT_VRS:
+        value_type = pa.float64()
+    elif vr in INTEGER_VRS:
+        value_type = pa.int64()
+    else:
+        value_type = pa.string()
+    return value_type if vm == "1" else pa.list_(value_type)
+
+
+def arrow_schema(keys: Iterable[str] = DICOM_TAGS_TO_KEEP) -> pa.Schema:
+    return pa.schema([pa.field(key, arrow_type(key)) for key in keys])
+
+
+SCHEMA = arrow_schema()
+
+
+def _coerce(value, type_: pa.DataType):
+    """Fit a header value to its column type, None if it does not fit."""
+    if value is None or value == "":
+        return None
+    if pa.types.is_list(type_):
+        values = value if isinstance(value, list) else [value]
+        return [_coerce(v, type_.value_type) for v in values]
+    if isinstance(value, list):
+        # a single valued element with several values in a non conformant file
+        value = "\\".join(str(v) for v in value) if pa.types.is_string(type_) else value[0]
+    try:
+        if pa.types.is_floating(type_):
+            return float(value)
+        if pa.types.is_integer(type_):
+            return int(value)
+    except (TypeError, ValueError):
+        return None
+    return str(value)
+
+
+def records_to_batch(records: List[Dict], schema: pa.Schema = SCHEMA) -> pa.RecordBatch:
+    columns = [
+        pa.array([_coerce(record.get(field.name), field.type) for record in records], type=field.type)
+        for field in schema
+    ]
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def write_parquet(records: Iterable[Dict], path: pathlib.Path, schema: pa.Schema = SCHEMA,
+                  row_group_size: int = ROW_GROUP_SIZE) -> int:
+    """Stream records to a parquet file, one row group at a time.
+
+    Keys of the records missing from the schema are dropped.
+
+    Returns
+    -------
+    int
+        The number of rows written.
+    """
+    records = iter(records)
+    rows = 0
+    part_path = path.with_name(path.name + ".part")
+    with pq.ParquetWriter(str(part_path), schema) as writer:
+        for chunk in iter(lambda: list(itertools.islice(records, row_group_size)), []):
+            writer.write_batch(records_to_batch(chunk, schema))
+            rows += len(chunk)
+    part_path.replace(path)
+    return rows
@@ -0,0 +1,86 @@
+"""Order the series of one or several manifests before downloading them.
+
+Starting the largest series first keeps a huge series picked up last from
+stretching the end of the run. Series listed in several manifests are
+downloaded once.
+"""
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from statistics import median
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import requests
+
+SIZE_SERVICE = "getSeriesSize"
+
+
+@dataclass
+class ManifestPlan:
+    """A manifest taking part in a download, and its series still to download."""
+    name: str
+    destination_folder: pathlib.Path
+    todo: List[str]
+    weight: float = 1.0
+    expected_sizes: Dict[str, int] = field(default_factory=dict)
+
+
+def parse_priorities(priorities: Iterable[str]) -> Dict[str, float]:
+    """Parse NAME=WEIGHT strings, NAME being the manifest file name."""
+    weights = {}
+    for priority in priorities:
+        name, _, weight = priority.rpartition("=")
+        if not name:
+            raise ValueError(f"Invalid priority {priority}, expected MANIFEST=WEIGHT")
+        weights[name] = float(weight)
+    return weights
+
+
+def query_series_size(serie_id: str, session: requests.Session, endpoint: str) -> Optional[int]:
+    """Ask the TCIA API for the size of a series, None if it can not tell."""
+    url = endpoint.rsplit("/", 1)[0] + "/" + SIZE_SERVICE
+    try:
+        r = session.get(url, params={"SeriesInstanceUID": serie_id}, timeout=30)
+        r.raise_for_status()
+        return int(float(r.json()[0]["TotalSizeInBytes"]))
+    except (requests.RequestException, ValueError, LookupError, TypeError):
+        return None
+
+
+def presize(series: Iterable[str], session: requests.Session, endpoint: str, njobs: int) -> Dict[str, int]:
+    """Query the size of all the series, njobs at a time."""
+    series = list(series)
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        sizes = executor.map(lambda serie_id: query_series_size(serie_id, session, endpoint), series)
+        return {serie_id: size for serie_id, size in zip(series, sizes) if size is not None}
+
+
+def owners_of(plans: List[ManifestPlan]) -> Dict[str, List[ManifestPlan]]:
+    """The manifests still needing each series, in the order of the plans."""
+    owners: Dict[str, List[ManifestPlan]] = {}
+    for plan in plans:
+        for serie_id in plan.todo:
+            owners.setdefault(serie_id, []).append(plan)
+    return owners
+
+
+def order_jobs(owners: Dict[str, List[ManifestPlan]],
+               sizes: Dict[str, int]) -> List[Tuple[str, pathlib.Path, Tuple[pathlib.Path, ...]]]:
+    """Jobs for src.scheduler.run_downloads, the heaviest first.
+
+    A series weighs its expected size times the largest weight of the
+    manifests listing it. Series of unknown size weigh the median size. Each
+    job downloads the series in the folder of the first manifest, and links
+    it in the folders of the others.
+    """
+    default_size = median(sizes.values()) if sizes else 1
+    ordered = sorted(
+        owners,
+        key=lambda serie_id: sizes.get(serie_id, default_size) * max(plan.weight for plan in owners[serie_id]),
+        reverse=True,  # sorted is stable, so the manifest order breaks ties
+    )
+    return [
+        (serie_id, owners[serie_id][0].destination_folder / serie_id,
+         tuple(plan.destination_folder / serie_id for plan in owners[serie_id][1:]))
+        for serie_id in ordered
+    ]
@@ -0,0 +1,114 @@
+"""Slice headers spilled to disk, grouped by series.
+
+Holding every slice header in memory as a dict takes tens of GB on large
+collections. SliceStore writes them to a temporary SQLite file as they come
+from the workers, as tuples of values whose keys are interned once per
+distinct set of keys, and gives them back one series at a time. What stays
+in memory grows with the number of series, not of slices.
+"""
+import pickle
+import sqlite3
+import tempfile
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+SCHEMA = """
+CREATE TABLE slices (
+    series INTEGER NOT NULL,
+    layout INTEGER NOT NULL,
+    slice_values BLOB NOT NULL
+);
+CREATE INDEX slices_series ON slices (series);
+"""
+INT, FLOAT, OTHER = 1, 2, 4
+
+
+class SliceStore:
+    """Temporary store of slice headers, keyed on their SeriesInstanceUID.
+
+    Parameters
+    ----------
+    directory : Path
+        Where to create the temporary file, the source folder rather than
+        a possibly small /tmp.
+    """
+
+    def __init__(self, directory: Path):
+        self.file = tempfile.NamedTemporaryFile(prefix=".metadatas-", suffix=".sqlite", dir=str(directory))
+        self.connection = sqlite3.connect(self.file.name)
+        self.connection.execute("PRAGMA journal_mode=OFF")
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.connection.executescript(SCHEMA)
+        self.series_ids: Dict[str, int] = {}
+        self.layouts: Dict[Tuple[str, ...], int] = {}
+        self.layout_keys: List[Tuple[str, ...]] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+        self.file.close()  # deletes it
+
+    def _row(self, record: Dict) -> Tuple[int, int, bytes]:
+        series = self.series_ids.setdefault(record["SeriesInstanceUID"], len(self.series_ids))
+        keys = tuple(record)
+        layout = self.layouts.get(keys)
+        if layout is None:
+            layout = self.layouts[keys] = len(self.layout_keys)
+            self.layout_keys.append(keys)
+        return series, layout, pickle.dumps(tuple(record.values()), pickle.HIGHEST_PROTOCOL)
+
+    def add(self, records: Iterable[Dict]) -> None:
+        with self.connection:
+            self.connection.executemany("INSERT INTO slices VALUES (?, ?, ?)", (self._row(r) for r in records))
+
+    def series(self) -> Iterator[Tuple[int, List[Dict]]]:
+        """(series id, slice headers) of each series, in the order they were first seen."""
+        rows = self.connection.execute("SELECT series, layout, slice_values FROM slices ORDER BY series, rowid")
+        current, slices = None, []
+        for series, layout, slice_values in rows:
+            if series != current:
+                if slices:
+                    yield current, slices
+                current, slices = series, []
+            slices.append(dict(zip(self.layout_keys[layout], pickle.loads(slice_values))))
+        if slices:
+            yield current, slices
+
+
+class ColumnTypes:
+    """Column order and dtypes pandas would give to a DataFrame of all the kept slices.
+
+    Used to write the csv in chunks with the same content as
+    pd.DataFrame.from_records(all_slices).to_csv().
+    """
+
+    def __init__(self):
+        self.columns: Dict[str, List[int]] = {}  # key -> [count of non null values, kinds]
+        self.rows = 0
+
+    def add(self, slices: List[Dict]) -> None:
+        self.rows += len(slices)
+        for metas in slices:
+            for key, value in metas.items():
+                stats = self.columns.setdefault(key, [0, 0])
+                if value is None:
+                    continue
+                stats[0] += 1
+                t = type(value)
+                stats[1] |= INT if t is int else FLOAT if t is float else OTHER
+
+    def frame(self, slices: List[Dict]) -> pd.DataFrame:
+        """DataFrame of some of the kept slices, with the dtypes of the whole table."""
+        df = pd.DataFrame(slices, columns=list(self.columns), dtype=object)
+        for key, (count, kinds) in self.columns.items():
+            if kinds and not kinds & OTHER:
+                df[key] = df[key].astype(np.float64 if kinds & FLOAT or count < self.rows else np.int64)
+        return df
@@ -0,0 +1,224 @@
+"""Run downloads with an adaptive number of concurrent transfers.
+
+The number of transfers allowed at once grows while the measured throughput
+grows, and is halved when the server pushes back (429, 5xx, timeouts).
+Failed series are retried with a jittered exponential backoff; the ones that
+still fail are returned at the end instead of stopping the run.
+"""
+import heapq
+import pathlib
+import random
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, wait
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import requests
+import urllib3
+
+THROTTLE_STATUS = 429
+RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504)
+NETWORK_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    urllib3.exceptions.HTTPError,  # raised when the body is read from Response.raw
+)
+
+
+class TransferError(Exception):
+    """A failed transfer, simplified so it can cross process boundaries."""
+
+    def __init__(self, message: str, retryable: bool, throttled: bool,
+                 retry_after: Optional[float] = None):
+        super().__init__(message, retryable, throttled, retry_after)
+        self.message = message
+        self.retryable = retryable
+        self.throttled = throttled
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return self.message
+
+
+def _retry_after(response: requests.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After", "")
+    return float(value) if value.isdigit() else None
+
+
+def classify(error: Exception, retryable: Tuple = ()) -> TransferError:
+    """Turn any exception raised by a transfer into a TransferError.
+
+    Parameters
+    ----------
+    error : Exception
+        The exception raised
+    retryable : Tuple
+        Other exception types worth a retry, e.g. corrupted downloads.
+        They do not count as the server pushing back.
+
+    Returns
+    -------
+    TransferError
+    """
+    message = f"{type(error).__name__}: {error}"
+    if isinstance(error, TransferError):
+        return error
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return TransferError(message, status in RETRYABLE_STATUS, status == THROTTLE_STATUS or status >= 500,
+                             _retry_after(error.response))
+    if isinstance(error, NETWORK_ERRORS):
+        return TransferError(message, True, True)
+    return TransferError(message, isinstance(error, retryable), False)
+
+
+def run_guarded(fetch: Callable, retryable: Tuple, *args):
+    """Call fetch(*args), raising only TransferError. Runs in the workers."""
+    try:
+        return fetch(*args)
+    except Exception as error:  # pylint: disable=broad-except
+        raise classify(error, retryable) from None
+
+
+class AdaptiveLimit:
+    """Concurrency limit driven by throughput and server errors.
+
+    Every `window` seconds the throughput of the finished transfers is
+    compared to the previous window: the limit is raised by one while it
+    keeps improving, and the last raise is undone when it degrades.
+    A throttling error halves the limit, at most once per window.
+    """
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: Optional[int] = None,
+                 window: float = 10.0, tolerance: float = 0.05):
+        self.minimum = minimum
+        self.maximum = max(initial, maximum or initial)
+        self.limit = min(max(initial, minimum), self.maximum)
+        self.window = window
+        self.tolerance = tolerance
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._last_rate = None
+        self._last_move = 0
+        self._last_throttle = float("-inf")
+
+    def on_success(self, nbytes: int, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        self._window_bytes += nbytes
+        elapsed = now - self._window_start
+        if elapsed < self.window:
+            return
+        rate = self._window_bytes / elapsed
+        if self._last_rate is None or rate > self._last_rate * (1 + self.tolerance):
+            self._move(+1)
+        elif rate < self._last_rate * (1 - self.tolerance) and self._last_move > 0:
+            self._move(-1)
+        else:
+            self._last_move = 0
+        self._last_rate = rate
+        self._window_start = now
+        self._window_bytes = 0
+
+    def on_throttle(self, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        if now - self._last_throttle < self.window:
+            # the other transfers of the same burst are failing too
+            return
+        self._last_throttle = now
+        self.limit = max(self.minimum, self.limit // 2)
+        self._last_move = 0
+        self._last_rate = None
+        self._window_start = now
+        self._window_bytes = 0
+
+    def _move(self, step: int) -> None:
+        new_limit = min(self.maximum, max(self.minimum, self.limit + step))
+        self._last_move = new_limit - self.limit
+        self.limit = new_limit
+
+
+def backoff(attempt: int, base: float = 1.0, cap: float = 300.0) -> float:
+    """Full jitter exponential backoff, in seconds."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def run_downloads(executor: Executor, fetch: Callable, jobs: Iterable[Tuple[str, pathlib.Path]],
+                  limit: AdaptiveLimit, retries: int = 5, retryable: Tuple = (),
+                  listeners: Sequence = ()) -> Dict[str, TransferError]:
+    """Download all the jobs, keeping `limit.limit` of them running.
+
+    Parameters
+    ----------
+    executor : Executor
+        It should have at least `limit.maximum` workers.
+    fetch : Callable
+        Called as fetch(*job) in the executor. It returns an object with a
+        `transferred` attribute, the number of bytes received.
+    jobs : Iterable[Tuple[str, pathlib.Path]]
+        The series to download, and where, in the order they should start.
+        Other job items are passed to fetch as is.
+    limit : AdaptiveLimit
+        The concurrency controller
+    retries : int
+        Number of retries for each series, after the first attempt
+    retryable : Tuple
+        Exception types that should be retried, in addition to network and
+        server errors.
+    listeners : Sequence
+        Objects notified, from the calling thread, of each attempt through
+        their started(serie_id), succeeded(serie_id, result) and
+        failed(serie_id, error, final) methods.
+
+    Returns
+    -------
+    Dict[str, TransferError]
+        The series that could not be downloaded, with their last error.
+    """
+    pending = deque((job, 0) for job in jobs)
+    delayed: List = []  # heap of (ready_at, counter, job, attempt)
+    running = {}
+    failures = {}
+    counter = 0
+    while pending or delayed or running:
+        now = time.monotonic()
+        while delayed and delayed[0][0] <= now:
+            _, _, job, attempt = heapq.heappop(delayed)
+            pending.appendleft((job, attempt))
+        while pending and len(running) < limit.limit:
+            job, attempt = pending.popleft()
+            future = executor.submit(run_guarded, fetch, retryable, *job)
+            running[future] = (job, attempt)
+            for listener in listeners:
+                listener.started(job[0])
+        if not running:
+            time.sleep(max(0.0, delayed[0][0] - now))
+            continue
+        timeout = max(0.0, delayed[0][0] - now) if delayed else None
+        done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            job, attempt = running.pop(future)
+            serie_id = job[0]
+            try:
+                result = future.result()
+            except TransferError as error:
+                failures[serie_id] = error
+                final = not (error.retryable and attempt < retries)
+                for listener in listeners:
+                    listener.failed(serie_id, error, final)
+                if error.throttled:
+                    limit.on_throttle()
+                if not final:
+                    delay = max(backoff(attempt), error.retry_after or 0)
+                    print(f"Series {serie_id} failed ({error}), retry {attempt + 1}/{retries} "
+                          f"in {delay:.1f}s, {limit.limit} concurrent transfers")
+                    counter += 1
+                    heapq.heappush(delayed, (time.monotonic() + delay, counter, job, attempt + 1))
+                else:
+                    print(f"Series {serie_id} failed: {error}")
+            else:
+                limit.on_success(result.transferred)
+                failures.pop(serie_id, None)
+                for listener in listeners:
+                    listener.succeeded(serie_id, result)
+    return failures
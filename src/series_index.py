@@ -0,0 +1,290 @@
+"""Patient, study and series index of the metadata DB.
+
+It is rebuilt by src.create_csv_db from the series it keeps, next to
+metadatas.csv, and answers cohort selections without loading the csv:
+
+python -m src.series_index query /data/tcia --modality CT --min-slices 50
+python -m src.series_index query /data/tcia --modality PT --patient PET-001 --files
+"""
+import argparse
+import ast
+import collections
+import math
+import os
+import pathlib
+import sqlite3
+import sys
+from statistics import median
+from typing import Dict, List, Optional, Sequence
+
+from src.metadata_index import MEMBER_SEPARATOR
+
+SCHEMA = """
+CREATE TABLE patients (
+    patient_id TEXT PRIMARY KEY,
+    patient_name TEXT,
+    studies INTEGER NOT NULL,
+    series INTEGER NOT NULL
+);
+CREATE TABLE studies (
+    study_uid TEXT PRIMARY KEY,
+    patient_id TEXT,
+    study_date TEXT,
+    study_description TEXT,
+    series INTEGER NOT NULL
+);
+CREATE TABLE series (
+    series_uid TEXT PRIMARY KEY,
+    study_uid TEXT,
+    patient_id TEXT,
+    modality TEXT,
+    series_description TEXT,
+    series_number INTEGER,
+    frame_of_reference_uid TEXT,
+    slices INTEGER NOT NULL,
+    rows INTEGER,
+    columns INTEGER,
+    pixel_spacing_row REAL,
+    pixel_spacing_column REAL,
+    slice_spacing REAL,
+    z_min REAL,
+    z_max REAL,
+    orientation_consistent INTEGER NOT NULL
+);
+CREATE TABLE files (
+    series_uid TEXT NOT NULL,
+    location TEXT NOT NULL,
+    instance_number INTEGER,
+    z REAL
+);
+CREATE INDEX studies_patient ON studies (patient_id);
+CREATE INDEX series_study ON series (study_uid);
+CREATE INDEX series_patient ON series (patient_id);
+CREATE INDEX series_modality ON series (modality);
+CREATE INDEX files_series ON files (series_uid, z);
+"""
+SERIES_COLUMNS = ("series_uid", "patient_id", "modality", "slices", "slice_spacing", "z_min", "z_max",
+                  "orientation_consistent", "series_description")
+
+parser = argparse.ArgumentParser("query the series index built by src.create_csv_db")
+subparsers = parser.add_subparsers(dest="command", required=True)
+query_parser = subparsers.add_parser("query", help="list the series matching all the given conditions")
+query_parser.add_argument("source", help="the folder given to src.create_csv_db")
+query_parser.add_argument("--modality", help="CT, PT, MR... (repeatable)", action="append")
+query_parser.add_argument("--patient", help="PatientID (repeatable)", action="append")
+query_parser.add_argument("--study", help="StudyInstanceUID (repeatable)", action="append")
+query_parser.add_argument("--series", help="SeriesInstanceUID (repeatable)", action="append")
+query_parser.add_argument("--description", help="SeriesDescription pattern, with %% as wildcard, case insensitive")
+query_parser.add_argument("--min-slices", type=int)
+query_parser.add_argument("--max-slice-spacing", help="in mm", type=float)
+query_parser.add_argument("--consistent", help="only series whose slices share the same orientation",
+                          action="store_true")
+query_parser.add_argument("--files", help="print the files of the series, ordered along the slice axis, "
+                                          "instead of the series", action="store_true")
+
+
+def series_index_path(folder: pathlib.Path) -> pathlib.Path:
+    return folder / "metadatas.series.sqlite"
+
+
+def plain_value(value):
+    """Undo the repr of UIDs and lists of the csv headers, typed headers are left as is."""
+    if isinstance(value, str) and value[:1] in ("'", "["):
+        try:
+            return ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            return value
+    return value
+
+
+def _numbers(value) -> Optional[List[float]]:
+    value = plain_value(value)
+    if not isinstance(value, list):
+        return None
+    try:
+        return [float(v) for v in value]
+    except (TypeError, ValueError):
+        return None
+
+
+def _scalar(value):
+    """None instead of the NaN or empty string of a missing element."""
+    if value is None or value == "" or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return plain_value(value)
+
+
+def _location(metas: Dict) -> str:
+    if metas.get("member"):
+        return f"{metas['archive']}{MEMBER_SEPARATOR}{metas['member']}"
+    return metas["file_location"]
+
+
+def _slice_normal(orientation: Optional[List[float]]) -> List[float]:
+    if orientation is None or len(orientation) != 6:
+        return [0.0, 0.0, 1.0]
+    (rx, ry, rz), (cx, cy, cz) = orientation[:3], orientation[3:]
+    return [ry * cz - rz * cy, rz * cx - rx * cz, rx * cy - ry * cx]
+
+
+def summarize_series(slices: Sequence[Dict]) -> Dict:
+    """Aggregates of a series, and its files ordered along the slice axis.
+
+    Slice positions are projected on the normal of the slices, so the z
+    extent and spacing are also right for sagittal or coronal series.
+    """
+    first = slices[0]
+    orientations = [_numbers(metas.get("ImageOrientationPatient")) for metas in slices]
+    consistent = all(
+        o is not None and orientations[0] is not None and all(abs(a - b) < 1e-4 for a, b in zip(o, orientations[0]))
+        for o in orientations
+    )
+    normal = _slice_normal(orientations[0])
+    files = []
+    for metas in slices:
+        position = _numbers(metas.get("ImagePositionPatient"))
+        z = sum(p * n for p, n in zip(position, normal)) if position is not None and len(position) == 3 else None
+        files.append((_location(metas), _scalar(metas.get("InstanceNumber")), z))
+    files.sort(key=lambda file: (file[2] is None, file[2] or 0, file[1] or 0))
+    zs = sorted({z for _, _, z in files if z is not None})
+    steps = [b - a for a, b in zip(zs, zs[1:])]
+    pixel_spacing = (_numbers(first.get("PixelSpacing")) or []) + [None, None]
+    return {
+        "series_uid": _scalar(first["SeriesInstanceUID"]),
+        "study_uid": _scalar(first.get("StudyInstanceUID")),
+        "patient_id": _scalar(first.get("PatientID")),
+        "modality": _scalar(first.get("Modality")),
+        "series_description": _scalar(first.get("SeriesDescription")),
+        "series_number": _scalar(first.get("SeriesNumber")),
+        "frame_of_reference_uid": _scalar(first.get("FrameOfReferenceUID")),
+        "slices": len(slices),
+        "rows": _scalar(first.get("Rows")),
+        "columns": _scalar(first.get("Columns")),
+        "pixel_spacing_row": pixel_spacing[0],
+        "pixel_spacing_column": pixel_spacing[1],
+        "slice_spacing": median(steps) if steps else None,
+        "z_min": zs[0] if zs else None,
+        "z_max": zs[-1] if zs else None,
+        "orientation_consistent": int(consistent),
+        "files": files,
+    }
+
+
+class SeriesIndexWriter:
+    """Write the index one series at a time.
+
+    The index is written next to path and moved over it by close(), so a
+    query never sees a partial index.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.part_path = path.with_name(path.name + ".part")
+        if self.part_path.exists():
+            self.part_path.unlink()
+        self.connection = sqlite3.connect(str(self.part_path))
+        self.connection.executescript(SCHEMA)
+        self.studies, self.patients = {}, {}
+        self.series_by_study, self.series_by_patient = collections.Counter(), collections.Counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.connection.close()
+
+    def add(self, slices: Sequence[Dict]) -> None:
+        """Index a series, given as the list of its slice headers."""
+        summary = summarize_series(slices)
+        files = summary.pop("files")
+        columns = ", ".join(summary)
+        self.connection.execute(f"INSERT INTO series ({columns}) VALUES ({', '.join('?' * len(summary))})",
+                                tuple(summary.values()))
+        self.connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?)",
+                                    ((summary["series_uid"], *file) for file in files))
+        first = slices[0]
+        self.studies.setdefault(summary["study_uid"], (summary["patient_id"], _scalar(first.get("StudyDate")),
+                                                       _scalar(first.get("StudyDescription"))))
+        self.patients.setdefault(summary["patient_id"], _scalar(first.get("PatientName")))
+        self.series_by_study[summary["study_uid"]] += 1
+        self.series_by_patient[summary["patient_id"]] += 1
+
+    def close(self) -> None:
+        self.connection.executemany(
+            "INSERT INTO studies VALUES (?, ?, ?, ?, ?)",
+            ((uid, *study, self.series_by_study[uid]) for uid, study in self.studies.items()),
+        )
+        studies_by_patient = collections.Counter(patient_id for patient_id, _, _ in self.studies.values())
+        self.connection.executemany(
+            "INSERT INTO patients VALUES (?, ?, ?, ?)",
+            ((patient_id, name, studies_by_patient[patient_id], self.series_by_patient[patient_id])
+             for patient_id, name in self.patients.items()),
+        )
+        self.connection.commit()
+        self.connection.close()
+        os.replace(self.part_path, self.path)
+
+
+def _in(column: str, values: Optional[List[str]], conditions: List[str], parameters: List) -> None:
+    if values:
+        conditions.append(f"{column} IN ({', '.join('?' * len(values))})")
+        parameters.extend(values)
+
+
+def select_series(connection: sqlite3.Connection, modality=None, patient=None, study=None, series=None,
+                  description=None, min_slices=None, max_slice_spacing=None, consistent=False) -> List[sqlite3.Row]:
+    """The series matching all the given conditions, list ones matching any of their values."""
+    conditions, parameters = [], []
+    _in("modality", modality, conditions, parameters)
+    _in("patient_id", patient, conditions, parameters)
+    _in("study_uid", study, conditions, parameters)
+    _in("series_uid", series, conditions, parameters)
+    if description is not None:
+        conditions.append("series_description LIKE ?")
+        parameters.append(description)
+    if min_slices is not None:
+        conditions.append("slices >= ?")
+        parameters.append(min_slices)
+    if max_slice_spacing is not None:
+        conditions.append("slice_spacing <= ?")
+        parameters.append(max_slice_spacing)
+    if consistent:
+        conditions.append("orientation_consistent = 1")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return connection.execute(f"SELECT * FROM series {where} ORDER BY patient_id, study_uid, series_number",
+                              parameters).fetchall()
+
+
+def series_files(connection: sqlite3.Connection, series_uid: str) -> List[str]:
+    """Files of a series, ordered along the slice axis."""
+    # the files of a series are inserted in this order by SeriesIndexWriter.add
+    rows = connection.execute("SELECT location FROM files WHERE series_uid = ? ORDER BY rowid", (series_uid,))
+    return [location for location, in rows]
+
+
+def query(args) -> None:
+    path = series_index_path(pathlib.Path(args.source).expanduser().resolve())
+    if not path.exists():
+        sys.exit(f"No series index in {args.source}, run src.create_csv_db on it first")
+    connection = sqlite3.connect(str(path))
+    connection.row_factory = sqlite3.Row
+    rows = select_series(connection, args.modality, args.patient, args.study, args.series, args.description,
+                         args.min_slices, args.max_slice_spacing, args.consistent)
+    if args.files:
+        for row in rows:
+            print("\n".join(series_files(connection, row["series_uid"])))
+    else:
+        print("\t".join(SERIES_COLUMNS))
+        for row in rows:
+            print("\t".join("" if row[column] is None else str(row[column]) for column in SERIES_COLUMNS))
+    connection.close()
+
+
+COMMANDS = {"query": query}
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    COMMANDS[args.command](args)
@@ -0,0 +1,168 @@
+"""Where the time of src.create_csv_db goes.
+
+The code of each stage runs in `with stage("read"):`, which does nothing
+unless profiling is enabled in the process: RunProfile enables it in the
+main process, and profiled() for each worker task. Workers send their stage
+times back with the task result, and RunProfile prints a summary with the
+throughput and the utilisation of each worker, to size the number of jobs
+for a given storage. Each worker can also dump its cProfile stats:
+
+python -m pstats /data/tcia/profile/worker-1234.prof
+"""
+import collections
+import cProfile
+import os
+import pathlib
+import time
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+_current: Optional["StageTimes"] = None
+_profiler: Optional[cProfile.Profile] = None  # one per worker process, for all its tasks
+_NULL = nullcontext()
+
+
+@dataclass
+class StageTimes:
+    wall: Dict[str, float] = field(default_factory=collections.Counter)
+    cpu: Dict[str, float] = field(default_factory=collections.Counter)
+    calls: Dict[str, int] = field(default_factory=collections.Counter)
+    files: int = 0
+    nbytes: int = 0
+
+    def add(self, other: "StageTimes") -> None:
+        self.wall.update(other.wall)
+        self.cpu.update(other.cpu)
+        self.calls.update(other.calls)
+        self.files += other.files
+        self.nbytes += other.nbytes
+
+
+@dataclass
+class TaskStats:
+    pid: int
+    wall: float
+    cpu: float
+    times: StageTimes
+
+
+@contextmanager
+def _timed(times: StageTimes, name: str):
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        times.wall[name] += time.perf_counter() - wall
+        times.cpu[name] += time.process_time() - cpu
+        times.calls[name] += 1
+
+
+def stage(name: str):
+    """Context manager timing a stage, if profiling is enabled."""
+    return _NULL if _current is None else _timed(_current, name)
+
+
+def count(files: int = 0, nbytes: int = 0) -> None:
+    """Count files and bytes read, if profiling is enabled."""
+    if _current is not None:
+        _current.files += files
+        _current.nbytes += nbytes
+
+
+def timed_iter(iterable: Iterable, name: str) -> Iterator:
+    """Time the production of the items of a lazy iterable, like a directory walk."""
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def profiled(function: Callable, *args, profile_dir: Optional[str] = None, **kwargs):
+    """Worker side: run function, recording its stages.
+
+    Returns
+    -------
+    Tuple
+        The result of function, and the TaskStats of the task.
+    """
+    global _current, _profiler
+    previous, _current = _current, StageTimes()  # with n_jobs=1, tasks run in the main process
+    wall, cpu = time.perf_counter(), time.process_time()
+    if profile_dir is not None:
+        _profiler = _profiler or cProfile.Profile()
+        _profiler.enable()
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        if profile_dir is not None:
+            _profiler.disable()
+            # stats of all the tasks run so far by this worker
+            _profiler.dump_stats(str(pathlib.Path(profile_dir) / f"worker-{os.getpid()}.prof"))
+        times, _current = _current, previous
+    return result, TaskStats(os.getpid(), time.perf_counter() - wall, time.process_time() - cpu, times)
+
+
+class RunProfile:
+    """Main side: stages of the main process and of all the worker tasks.
+
+    Parameters
+    ----------
+    profile_dir : pathlib.Path, optional
+        If given, each worker dumps its cProfile stats there.
+    """
+
+    def __init__(self, profile_dir: Optional[pathlib.Path] = None):
+        self.profile_dir = profile_dir
+        if profile_dir is not None:
+            profile_dir.mkdir(parents=True, exist_ok=True)
+        self.main = StageTimes()
+        self.workers = StageTimes()
+        self.tasks: List[TaskStats] = []
+        self.start = time.perf_counter()
+
+    def __enter__(self):
+        global _current
+        _current = self.main
+        return self
+
+    def __exit__(self, *exc):
+        global _current
+        _current = None
+        self.elapsed = time.perf_counter() - self.start
+
+    def results(self, results: Iterable) -> Iterator:
+        """Unwrap the (result, TaskStats) of profiled tasks, keeping the stats."""
+        for result, stats in results:
+            self.tasks.append(stats)
+            self.workers.add(stats.times)
+            yield result
+
+    def summary(self) -> str:
+        elapsed = self.elapsed
+        lines = [f"{'stage':<12}{'wall s':>10}{'cpu s':>10}{'calls':>10}"]
+        for title, times in (("main", self.main), ("workers", self.workers)):
+            lines.append(f"{title}:")
+            for name in times.wall:
+                lines.append(f"  {name:<10}{times.wall[name]:>10.2f}{times.cpu[name]:>10.2f}{times.calls[name]:>10}")
+        files, nbytes = self.workers.files, self.workers.nbytes
+        lines.append(f"{files} files in {elapsed:.2f}s, {files / elapsed:.0f} files/s, "
+                     f"{nbytes / 1e6:.1f} MB of headers read, {nbytes / 1e6 / elapsed:.1f} MB/s")
+        parse_wall = self.main.wall.get("parse") or elapsed
+        by_worker = collections.defaultdict(list)
+        for task in self.tasks:
+            by_worker[task.pid].append(task)
+        lines.append(f"{'worker':<12}{'tasks':>10}{'busy s':>10}{'cpu s':>10}{'busy %':>10}")
+        for pid, tasks in sorted(by_worker.items()):
+            busy = sum(task.wall for task in tasks)
+            lines.append(f"{pid:<12}{len(tasks):>10}{busy:>10.2f}{sum(task.cpu for task in tasks):>10.2f}"
+                         f"{100 * busy / parse_wall:>10.0f}")
+        if by_worker:
+            idle = parse_wall * len(by_worker) - sum(task.wall for task in self.tasks)
+            lines.append(f"workers idle or waiting on the main process (IPC) for {idle:.2f}s "
+                         f"of {parse_wall * len(by_worker):.2f}s")
+        return "\n".join(lines)
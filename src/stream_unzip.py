@@ -0,0 +1,202 @@
+"""Extract a zip archive while its bytes are still arriving.
+
+zipfile needs the central directory, which is at the very end of the archive.
+The local file headers placed before each member are enough to extract them
+in order, which is what this module does.
+"""
+import pathlib
+import struct
+import zlib
+from typing import Optional
+
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+CENTRAL_DIRECTORY_SIGNATURES = (b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06")
+DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+ZIP64_EXTRA_ID = 0x0001
+STORED = 0
+DEFLATED = 8
+
+_HEADER, _NAME, _DATA, _DESCRIPTOR, _DONE = range(5)
+
+
+class StreamingZipError(Exception):
+    pass
+
+
+class CorruptedZipError(StreamingZipError):
+    """The bytes received are not the archive: truncated, or altered on the way. Worth another try."""
+
+
+class UnsupportedZipError(StreamingZipError):
+    """The archive is valid, but its layout can not be extracted in a stream. It will be the same next time."""
+
+
+class StreamingZipExtractor:
+    """Push parser writing zip members to a folder as chunks are fed.
+
+    Usage
+    -----
+    >>> extractor = StreamingZipExtractor(folder)
+    >>> for chunk in chunks:
+    ...     extractor.feed(chunk)
+    >>> extractor.close()
+
+    Stored and deflated members are supported, with or without data
+    descriptors, except stored members whose size is only given in the data
+    descriptor (their end can not be found without the central directory):
+    those raise UnsupportedZipError, to be extracted once the whole archive is
+    on disk. The CRC of each member is checked.
+    """
+
+    def __init__(self, dest_folder: pathlib.Path):
+        self.dest_folder = pathlib.Path(dest_folder)
+        self.members = []
+        self._buffer = bytearray()
+        self._state = _HEADER
+        self._header = None
+        self._out = None
+        self._remaining = 0
+        self._crc = 0
+        self._inflater = None
+        self._zip64 = False
+
+    def feed(self, chunk: bytes) -> None:
+        self._buffer += chunk
+        progress = True
+        while progress and self._state != _DONE:
+            progress = self._step()
+
+    def close(self) -> None:
+        if self._state != _DONE:
+            self._close_member()
+            raise CorruptedZipError(f"archive truncated, {len(self.members)} members extracted")
+
+    def _step(self) -> bool:
+        if self._state == _HEADER:
+            return self._read_header()
+        if self._state == _NAME:
+            return self._read_name()
+        if self._state == _DATA:
+            return self._read_data()
+        return self._read_descriptor()
+
+    def _read_header(self) -> bool:
+        if len(self._buffer) < 4:
+            return False
+        signature = bytes(self._buffer[:4])
+        if signature in CENTRAL_DIRECTORY_SIGNATURES:
+            # every member has been seen, the rest is the index
+            self._state = _DONE
+            self._buffer.clear()
+            return False
+        if signature != LOCAL_HEADER_SIGNATURE:
+            raise CorruptedZipError(f"unexpected signature {signature!r}")
+        if len(self._buffer) < LOCAL_HEADER.size:
+            return False
+        self._header = LOCAL_HEADER.unpack_from(self._buffer)
+        del self._buffer[:LOCAL_HEADER.size]
+        self._state = _NAME
+        return True
+
+    def _read_name(self) -> bool:
+        *_, flags, method, _time, _date, crc, csize, usize, name_len, extra_len = self._header
+        if len(self._buffer) < name_len + extra_len:
+            return False
+        encoding = "utf-8" if flags & 0x800 else "cp437"
+        name = bytes(self._buffer[:name_len]).decode(encoding)
+        extra = bytes(self._buffer[name_len:name_len + extra_len])
+        del self._buffer[:name_len + extra_len]
+        csize, usize, self._zip64 = _apply_zip64(extra, csize, usize)
+        has_descriptor = bool(flags & 0x08)
+        if method not in (STORED, DEFLATED):
+            raise UnsupportedZipError(f"{name}: compression method {method} not supported")
+        if method == STORED and has_descriptor and csize == 0:
+            raise UnsupportedZipError(f"{name}: stored member of unknown size")
+        self._header = (name, flags, method, crc)
+        self._remaining = csize
+        self._crc = 0
+        self._inflater = zlib.decompressobj(-zlib.MAX_WBITS) if method == DEFLATED else None
+        self._out = self._open_member(name)
+        self._state = _DATA
+        return True
+
+    def _read_data(self) -> bool:
+        if not self._buffer:
+            return False
+        if self._inflater is None:
+            data = bytes(self._buffer[:self._remaining])
+            del self._buffer[:len(data)]
+            self._remaining -= len(data)
+            self._write(data)
+            finished = self._remaining == 0
+        else:
+            data = self._inflater.decompress(bytes(self._buffer))
+            self._buffer = bytearray(self._inflater.unused_data)
+            self._write(data)
+            finished = self._inflater.eof
+        if not finished:
+            return False
+        has_descriptor = self._header[1] & 0x08
+        if has_descriptor:
+            self._state = _DESCRIPTOR
+        else:
+            self._end_member(self._header[3])
+        return True
+
+    def _read_descriptor(self) -> bool:
+        size_length = 8 if self._zip64 else 4
+        length = 4 + 2 * size_length
+        if len(self._buffer) < 4:
+            return False
+        if bytes(self._buffer[:4]) == DATA_DESCRIPTOR_SIGNATURE:
+            length += 4
+        if len(self._buffer) < length:
+            return False
+        crc, = struct.unpack_from("<I", self._buffer, length - 4 - 2 * size_length)
+        del self._buffer[:length]
+        self._end_member(crc)
+        return True
+
+    def _open_member(self, name: str) -> Optional[object]:
+        path = (self.dest_folder / name).resolve()
+        if self.dest_folder.resolve() not in path.parents:
+            raise UnsupportedZipError(f"{name}: member outside of the destination folder")
+        if name.endswith("/"):
+            path.mkdir(parents=True, exist_ok=True)
+            return None
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.members.append(path)
+        return path.open("wb")
+
+    def _write(self, data: bytes) -> None:
+        self._crc = zlib.crc32(data, self._crc)
+        if self._out is not None:
+            self._out.write(data)
+
+    def _close_member(self) -> None:
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+
+    def _end_member(self, expected_crc: int) -> None:
+        self._close_member()
+        if self._crc != expected_crc:
+            raise CorruptedZipError(f"{self._header[0]}: bad CRC")
+        self._state = _HEADER
+
+
+def _apply_zip64(extra: bytes, csize: int, usize: int):
+    """Read the real sizes from the zip64 extra field, if any."""
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, length = struct.unpack_from("<HH", extra, offset)
+        if header_id == ZIP64_EXTRA_ID:
+            values = iter(struct.unpack_from(f"<{length // 8}Q", extra, offset + 4))
+            if usize == 0xFFFFFFFF:
+                usize = next(values)
+            if csize == 0xFFFFFFFF:
+                csize = next(values)
+            return csize, usize, True
+        offset += 4 + length
+    return csize, usize, False
@@ -1,13 +1,32 @@
 import argparse
+import hashlib
 import json
+import os
 import pathlib
 import shutil
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import sys
+import time
+import zipfile
+import zlib
+from contextlib import nullcontext
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from src.file_io import read_txt
+from src.cache import SeriesCache, fetch_and_link, fetch_through_cache, parse_size
+from src.file_io import disk_size, read_txt
+from src.ledger import DownloadLedger, LedgerGroup, ledger_path
+from src.metrics import RunMetrics
+from src.planner import ManifestPlan, order_jobs, owners_of, parse_priorities, presize
+from src.scheduler import AdaptiveLimit, run_downloads
+from src.stream_unzip import CorruptedZipError, StreamingZipExtractor, UnsupportedZipError
+from src.unzip import extract_zip
 from src.utils import drop_until, remove_trailing_n
+from src.write_path import WriteOptions, stream_to_file
 
 TAKE_AFTER = "ListOfSeriesToDownload="
 TCIA_ENDPOINT = (
@@ -15,67 +34,446 @@ TCIA_ENDPOINT = (
 )
 
 
-def tcia_dl(serie_id: str, dest_file: pathlib.Path) -> pathlib.Path:
+ENGINES = ("thread", "process")
+TIMEOUT = (30, 120)  # seconds to connect, and between two received bytes
+
+
+def make_session(pool_size: int) -> requests.Session:
+    """Create a requests session sharing a pool of keep-alive connections.
+
+    Parameters
+    ----------
+    pool_size : int
+        Maximum number of connections kept open to the TCIA host. It should
+        match the number of concurrent downloads.
+
+    Returns
+    -------
+    requests.Session
+        A session whose adapters block instead of opening extra connections
+        when the pool is exhausted.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class CorruptedDownloadError(Exception):
+    pass
+
+
+def part_file_of(dest_file: pathlib.Path) -> pathlib.Path:
+    """Location of the partial download of dest_file."""
+    return dest_file.with_name(dest_file.name + ".part")
+
+
+def _check_is_zip(metadata: Optional[str], serie_id: str) -> None:
+    if metadata is None:
+        raise ValueError("No metadata header sent for this seriesID", serie_id)
+    metadata = json.loads(metadata)
+    filetype = metadata.get("Result").get("Type")[0]
+    if filetype != "ZIP":
+        raise ValueError(
+            "Supplied seriesID is not valid. No .zip file here", serie_id
+        )
+
+
+def _total_size(r: requests.Response) -> Optional[int]:
+    """Full size of the remote file, as announced by the server, if any."""
+    if r.status_code in (206, 416):
+        # Content-Range: bytes start-end/total, or bytes */total for a 416
+        total = r.headers.get("Content-Range", "").rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    length = r.headers.get("Content-Length")
+    return int(length) if length is not None and length.isdigit() else None
+
+
+def _range_start(r: requests.Response) -> int:
+    """First byte sent in a 206 response."""
+    unit_range = r.headers.get("Content-Range", "").partition("/")[0]
+    return int(unit_range.split(" ")[-1].split("-")[0])
+
+
+def verify_archive(archive: pathlib.Path, expected_size: Optional[int] = None, check_crc: bool = False) -> None:
+    """Check that a downloaded archive is complete.
+
+    Parameters
+    ----------
+    archive : pathlib.Path
+        The zip file to check
+    expected_size : int, optional
+        The size announced by the server
+    check_crc : bool
+        Also read every member and check its CRC, for the archives whose
+        first bytes come from an earlier download, the central directory
+        being only at the end.
+
+    Raises
+    ------
+    CorruptedDownloadError
+        If the size does not match, if the zip central directory can not
+        be read, or if a member is corrupted.
+    """
+    size = archive.stat().st_size
+    if expected_size is not None and size != expected_size:
+        raise CorruptedDownloadError(f"{archive} is {size} bytes long, expected {expected_size}")
+    try:
+        with zipfile.ZipFile(archive) as zip_archive:
+            corrupted = zip_archive.testzip() if check_crc else None
+    except (zipfile.BadZipFile, zlib.error) as error:
+        raise CorruptedDownloadError(f"{archive} is not a valid zip archive: {error}") from error
+    if corrupted is not None:
+        raise CorruptedDownloadError(f"{archive}: {corrupted} is corrupted")
+
+
+@dataclass
+class DownloadResult:
+    """What a download produced, and what it took."""
+    path: pathlib.Path
+    size: int  # bytes of the archive, or of the extracted files if it was already there
+    transferred: int = 0  # bytes received by this call
+    duration: float = 0.0
+    checksum: Optional[str] = None  # sha256 of the archive
+    ttfb: float = 0.0  # seconds until the response headers were received
+
+
+def _sha256_of(path: pathlib.Path):
+    sha256 = hashlib.sha256()
+    with path.open("rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256
+
+
+def tcia_dl(serie_id: str, dest_file: pathlib.Path,
+            session: Optional[requests.Session] = None,
+            write_options: WriteOptions = WriteOptions(),
+            endpoint: str = TCIA_ENDPOINT) -> DownloadResult:
     """Download a file using requests.
+
+    The file is first written next to dest_file with a .part suffix. If such
+    a partial file already exists, the download resumes where it stopped,
+    provided the server honours Range requests. The archive is moved to
+    dest_file only once its size and zip structure, and the CRC of its
+    members for a resumed download, have been checked, so an existing
+    dest_file is always a complete download.
+
+    If a session is given, its connection pool is reused, else a new
+    connection is opened for this file only. write_options tunes how the
+    body is written to disk. endpoint is the URL of the getImage service.
     """
+    part_file = part_file_of(dest_file)
     if dest_file.exists():
-        # do not download, already there!
-        return dest_file
-    with requests.get(
-            TCIA_ENDPOINT, params={"SeriesInstanceUID": serie_id}, stream=True
+        if zipfile.is_zipfile(dest_file):
+            # do not download, already there!
+            return DownloadResult(dest_file, disk_size(dest_file))
+        # truncated archive left by a previous version: try to complete it
+        os.replace(dest_file, part_file)
+    start = time.perf_counter()
+    http = requests if session is None else session
+    offset = part_file.stat().st_size if part_file.exists() else 0
+    headers = {"Accept-Encoding": "identity"}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+    with http.get(
+            endpoint, params={"SeriesInstanceUID": serie_id}, headers=headers, stream=True,
+            timeout=TIMEOUT
     ) as r:
-        r.raise_for_status()
-        metadata = r.headers.get("metadata")
-        metadata = json.loads(metadata)
-        filetype = metadata.get("Result").get("Type")[0]
-        if filetype != "ZIP":
-            raise ValueError(
-                "Supplied seriesID is not valid. No .zip file here", serie_id
-            )
-        with dest_file.open("wb") as file:
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:  # filter out keep-alive new chunks
-                    file.write(chunk)
-        print(f"Series {serie_id} downloaded at {dest_file}")
-        assert dest_file.exists()
-        return dest_file
+        ttfb = time.perf_counter() - start
+        # a 416 or a misplaced range means the partial file can not be resumed
+        restart = r.status_code == 416 or (r.status_code == 206 and _range_start(r) != offset)
+        if not restart:
+            r.raise_for_status()
+            if r.status_code == 206:
+                mode = "r+b"
+                sha256 = _sha256_of(part_file)
+            else:
+                # the server ignored the Range header
+                _check_is_zip(r.headers.get("metadata"), serie_id)
+                mode = "wb"
+                offset = 0
+                sha256 = hashlib.sha256()
+            expected_size = _total_size(r)
+            with part_file.open(mode) as file:
+                file.seek(offset)
+                stream_to_file(r.raw, file, write_options,
+                               None if expected_size is None else expected_size - offset, [sha256.update])
+    if restart:
+        if r.status_code == 416 and _total_size(r) == offset:
+            # the partial file may be complete, left by a run stopped right before the rename
+            try:
+                verify_archive(part_file, offset, check_crc=True)
+            except CorruptedDownloadError:
+                pass
+            else:
+                os.replace(part_file, dest_file)
+                print(f"Series {serie_id} downloaded at {dest_file} (already complete)")
+                return DownloadResult(dest_file, offset, 0, time.perf_counter() - start,
+                                      _sha256_of(dest_file).hexdigest(), ttfb)
+        part_file.unlink()
+        return tcia_dl(serie_id, dest_file, session, write_options, endpoint)
+    try:
+        # the bytes before offset were written by an earlier call, only their CRC tells they are right
+        verify_archive(part_file, expected_size, check_crc=offset > 0)
+    except CorruptedDownloadError:
+        part_file.unlink()
+        raise
+    os.replace(part_file, dest_file)
+    resumed = f" (resumed at byte {offset})" if offset else ""
+    print(f"Series {serie_id} downloaded at {dest_file}{resumed}")
+    size = dest_file.stat().st_size
+    return DownloadResult(dest_file, size, size - offset, time.perf_counter() - start, sha256.hexdigest(), ttfb)
+
+
+def tcia_dl_extract(serie_id: str, dest_folder: pathlib.Path,
+                    session: Optional[requests.Session] = None,
+                    keep_archive: bool = False,
+                    write_options: WriteOptions = WriteOptions(),
+                    endpoint: str = TCIA_ENDPOINT) -> DownloadResult:
+    """Download a series and extract its files while the zip is downloading.
+
+    Files are extracted in dest_folder with a .part suffix, which is renamed
+    to dest_folder once the whole archive has been read. The archive itself
+    is only written to disk, next to dest_folder with a .zip suffix, if
+    keep_archive is True. An interrupted extraction is started over.
+
+    Archives whose layout can not be read in a stream, e.g. stored members
+    with a data descriptor, are downloaded with tcia_dl, then extracted.
+    """
+    if dest_folder.is_dir():
+        # do not download, already there!
+        return DownloadResult(dest_folder, disk_size(dest_folder))
+    start = time.perf_counter()
+    part_folder = part_file_of(dest_folder)
+    shutil.rmtree(part_folder, ignore_errors=True)
+    archive = dest_folder.with_name(dest_folder.name + ".zip")
+    part_archive = part_file_of(archive)
+    http = requests if session is None else session
+    sha256 = hashlib.sha256()
+    try:
+        with http.get(
+                endpoint, params={"SeriesInstanceUID": serie_id},
+                headers={"Accept-Encoding": "identity"}, stream=True, timeout=TIMEOUT
+        ) as r:
+            ttfb = time.perf_counter() - start
+            r.raise_for_status()
+            _check_is_zip(r.headers.get("metadata"), serie_id)
+            expected_size = _total_size(r)
+            extractor = StreamingZipExtractor(part_folder)
+            with (part_archive.open("wb") if keep_archive else nullcontext()) as archive_file:
+                size = stream_to_file(r.raw, archive_file, write_options, expected_size,
+                                      [extractor.feed, sha256.update])
+            extractor.close()
+    except UnsupportedZipError as error:
+        print(f"Series {serie_id} can not be extracted while downloading ({error}), downloading the archive first")
+        shutil.rmtree(part_folder, ignore_errors=True)
+        return _download_then_extract(serie_id, dest_folder, session, keep_archive, write_options, endpoint, start)
+    if expected_size is not None and size != expected_size:
+        raise CorruptedDownloadError(f"{serie_id}: received {size} bytes, expected {expected_size}")
+    if keep_archive:
+        verify_archive(part_archive, expected_size)
+        os.replace(part_archive, archive)
+    os.replace(part_folder, dest_folder)
+    print(f"Series {serie_id} extracted at {dest_folder} ({len(extractor.members)} files)")
+    return DownloadResult(dest_folder, size, size, time.perf_counter() - start, sha256.hexdigest(), ttfb)
+
+
+def _download_then_extract(serie_id: str, dest_folder: pathlib.Path,
+                           session: Optional[requests.Session], keep_archive: bool,
+                           write_options: WriteOptions, endpoint: str, start: float) -> DownloadResult:
+    """The fallback of tcia_dl_extract: the whole archive first, then its files.
+
+    With keep_archive, the archive written while streaming is resumed.
+    """
+    archive = dest_folder.with_name(dest_folder.name + ".zip")
+    part_folder = part_file_of(dest_folder)
+    result = tcia_dl(serie_id, archive, session, write_options, endpoint)
+    extract_zip(archive, part_folder)
+    if not keep_archive:
+        archive.unlink()
+    os.replace(part_folder, dest_folder)
+    print(f"Series {serie_id} extracted at {dest_folder}")
+    return DownloadResult(dest_folder, result.size, result.transferred, time.perf_counter() - start,
+                          result.checksum, result.ttfb)
 
 
 parser = argparse.ArgumentParser(
     description="The CLI to download images from the TCIA website"
 )
-parser.add_argument("manifest", help="The manifest file")
-parser.add_argument("dest_folder", help="The folder to download the images")
-parser.add_argument("--njobs", help="number of concurrent connections", type=int, default=5)
+subparsers = parser.add_subparsers(dest="command")
+download_parser = subparsers.add_parser("download", help="download the series of manifests (default command)")
+download_parser.add_argument("manifest", help="The manifest files. Series listed in several manifests are "
+                                              "downloaded once", nargs="+")
+download_parser.add_argument("dest_folder", help="The folder to download the images")
+download_parser.add_argument("--njobs", help="initial number of concurrent connections", type=int, default=5)
+download_parser.add_argument("--max-njobs", help="the number of concurrent connections grows up to this value "
+                                                 "while the throughput improves (default: --njobs, i.e. fixed)",
+                             type=int)
+download_parser.add_argument("--retries", help="number of retries for each series", type=int, default=5)
+download_parser.add_argument("--engine", help="thread: one shared keep-alive connection pool (default), "
+                                              "process: one process and connection per download",
+                             choices=ENGINES, default="thread")
+download_parser.add_argument("--extract", help="extract the series files while downloading instead of saving "
+                                               "the zip", action="store_true")
+download_parser.add_argument("--keep-archive", help="with --extract, also save the zip archive",
+                             action="store_true")
+download_parser.add_argument("--buffer-size", help="size of the reads and writes of each download, e.g. 4M",
+                             default="1M")
+download_parser.add_argument("--fsync-every", help="flush downloads to disk each time this much was written, "
+                                                   "e.g. 256M (default: never)")
+download_parser.add_argument("--no-preallocate", help="do not reserve the archive size on disk before "
+                                                      "downloading", action="store_true")
+download_parser.add_argument("--endpoint", help="URL of the getImage service, e.g. a src.mock_tcia server",
+                             default=TCIA_ENDPOINT)
+download_parser.add_argument("--prometheus", help="file kept up to date with the transfer metrics, in the "
+                                                  "Prometheus text format")
+download_parser.add_argument("--priority", help="MANIFEST=WEIGHT, series of a manifest with a higher weight "
+                                                "start earlier (default weight: 1)", action="append", default=[])
+download_parser.add_argument("--presize", help="ask the TCIA API the size of the series of unknown size, to start "
+                                               "the largest ones first", action="store_true")
+download_parser.add_argument("--cache", help="folder storing each series once for all manifests, the manifest "
+                                             "folder is then filled with hardlinks to it")
+status_parser = subparsers.add_parser("status", help="show the progress of a manifest download")
+status_parser.add_argument("manifest", help="The manifest file")
+status_parser.add_argument("dest_folder", help="The folder given to the download command")
+cache_parser = subparsers.add_parser("cache", help="show the size of a series cache, or shrink it")
+cache_parser.add_argument("cache", help="The cache folder")
+cache_parser.add_argument("--max-size", help="evict the least recently used series until the cache is smaller "
+                                             "than this size, e.g. 500G")
 
 
-def download():
-    args = parser.parse_args()
-    dest_folder = args.dest_folder
-    manifest = pathlib.Path(args.manifest)
-    destination_folder = pathlib.Path(dest_folder) / manifest.name
+def read_manifest(manifest: pathlib.Path) -> List[str]:
+    """List the series IDs of a manifest."""
+    with manifest.open() as open_manifest:
+        lines = read_txt(open_manifest)  # manifest file
+        lines = (remove_trailing_n(line) for line in lines)
+        return list(drop_until(lambda x: x == TAKE_AFTER, lines))
+
+
+def prepare_manifest(manifest: pathlib.Path, dest_folder: pathlib.Path,
+                     weight: float) -> Tuple[ManifestPlan, DownloadLedger]:
+    """Copy the manifest to its destination folder and open its ledger."""
+    destination_folder = dest_folder / manifest.name
     destination_folder.mkdir(exist_ok=True, parents=True)
     print(f"destination folder: {destination_folder} | manifest: {manifest}")
     # basic checks
     if not all([manifest.exists(), manifest.is_file()]):
         raise ValueError(f"{manifest} does not exist or is not a file")
+    shutil.copy(manifest, destination_folder)
+    ledger = DownloadLedger(ledger_path(destination_folder, manifest))
+    ledger.register(read_manifest(manifest))
+    plan = ManifestPlan(manifest.name, destination_folder, ledger.todo(), weight, ledger.expected_sizes())
+    return plan, ledger
+
+
+def download(args):
+    dest_folder = pathlib.Path(args.dest_folder)
+    manifests = [pathlib.Path(manifest) for manifest in args.manifest]
+    weights = parse_priorities(args.priority)
+    plans, ledgers = [], {}
+    for manifest in manifests:
+        plan, ledger = prepare_manifest(manifest, dest_folder, weights.get(manifest.name, 1.0))
+        plans.append(plan)
+        ledgers[plan.name] = ledger
+    owners = owners_of(plans)
 
     # processing pipeline
-    open_manifest = manifest.open()
-    shutil.copy(manifest, destination_folder)
-    lines = read_txt(open_manifest)  # manifest file
-    lines = (remove_trailing_n(line) for line in lines)
-    series_id = drop_until(lambda x: x == TAKE_AFTER, lines)
-    with ProcessPoolExecutor(max_workers=args.njobs) as executor:
-        futures = {executor.submit(tcia_dl, serie_id, destination_folder / serie_id): serie_id
-                   for
-                   serie_id in series_id}
-        for future in as_completed(futures):
-            future.result()
+    limit = AdaptiveLimit(args.njobs, maximum=args.max_njobs)
+    if args.engine == "process":
+        executor = ProcessPoolExecutor(max_workers=limit.maximum)
+        session = None
+    else:
+        executor = ThreadPoolExecutor(max_workers=limit.maximum)
+        session = make_session(limit.maximum)
+    sizes = {}
+    for plan in plans:
+        sizes.update(plan.expected_sizes)
+    if args.presize:
+        with make_session(args.njobs) as size_session:
+            queried = presize((uid for uid in owners if uid not in sizes), size_session, args.endpoint, args.njobs)
+        for plan in plans:
+            ledgers[plan.name].set_expected_sizes({uid: queried[uid] for uid in plan.todo if uid in queried})
+        sizes.update(queried)
+    jobs = order_jobs(owners, sizes)
+    print(f"{len(jobs)} series to download, {len(sizes)} of known size")
+    write_options = WriteOptions(parse_size(args.buffer_size), not args.no_preallocate,
+                                 parse_size(args.fsync_every) if args.fsync_every else 0)
+    if args.extract:
+        fetch = partial(tcia_dl_extract, session=session, keep_archive=args.keep_archive,
+                        write_options=write_options, endpoint=args.endpoint)
+    else:
+        fetch = partial(tcia_dl, session=session, write_options=write_options, endpoint=args.endpoint)
+    metrics = RunMetrics(len(jobs), prometheus_file=args.prometheus and pathlib.Path(args.prometheus))
+    owner_ledgers = {uid: [ledgers[plan.name] for plan in uid_plans] for uid, uid_plans in owners.items()}
+    listeners = [LedgerGroup(owner_ledgers), metrics]
+    if args.cache is not None:
+        cache = SeriesCache(args.cache, "extracted" if args.extract else "archives")
+        fetch = partial(fetch_through_cache, fetch, cache.store)
+        listeners.append(cache)
+    fetch = partial(fetch_and_link, fetch)
+    with executor:
+        failures = run_downloads(executor, fetch, jobs, limit, args.retries,
+                                 retryable=(CorruptedDownloadError, CorruptedZipError), listeners=listeners)
+    for ledger in ledgers.values():
+        ledger.close()
+    if args.cache is not None:
+        cache.close()
+    if session is not None:
+        session.close()
+    if len(plans) == 1:
+        report = plans[0].destination_folder / plans[0].name
+    else:
+        report = dest_folder / "download"
+    metrics.write_csv(report.with_name(report.name + ".report.csv"))
+    metrics.write_json(report.with_name(report.name + ".report.json"))
+    if args.prometheus is not None:
+        metrics.write_prometheus(pathlib.Path(args.prometheus))
+    metrics.print_summary()
+    if failures:
+        print(f"{len(failures)} series could not be downloaded:")
+        for serie_id, error in failures.items():
+            print(f"{serie_id}: {error}")
+
+
+def status(args):
+    manifest = pathlib.Path(args.manifest)
+    path = ledger_path(pathlib.Path(args.dest_folder) / manifest.name, manifest)
+    if not path.exists():
+        raise FileNotFoundError(f"No download found for {manifest} in {args.dest_folder}")
+    with DownloadLedger(path) as ledger:
+        for state, (count, size) in sorted(ledger.summary().items()):
+            print(f"{state:>8}: {count} series, {size / 1e9:.2f} GB")
+        for serie_id, attempts, error in ledger.errors():
+            print(f"{serie_id} ({attempts} attempts): {error}")
+
+
+def cache_command(args):
+    with SeriesCache(args.cache) as cache:
+        if args.max_size is not None:
+            evicted = cache.evict(parse_size(args.max_size))
+            print(f"{len(evicted)} series evicted")
+        count, size = cache.usage()
+        print(f"{count} series cached, {size / 1e9:.2f} GB")
+
+
+COMMANDS = {"download": download, "status": status, "cache": cache_command}
+
+
+def main(argv: Optional[List[str]] = None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] not in COMMANDS and argv[0] not in ("-h", "--help"):
+        # `python -m src.tcia manifest dest_folder` still means download
+        argv = ["download", *argv]
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error("a command is required")
+    COMMANDS[args.command](args)
 
 
 if __name__ == '__main__':
-    download()
+    main()
     #     for serie_id in series_id:
     #         filename = serie_id + ".zip"
     #         future =
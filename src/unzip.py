@@ -32,8 +32,12 @@ def unzip_file(file, root_folder):
         unzip_specific_folder = root_folder / file.name
         unzip_specific_folder.mkdir(exist_ok=True)
         print(f"Decompressing in {unzip_specific_folder}")
-        with ZipFile(file) as item:
-            item.extractall(unzip_specific_folder)
+        extract_zip(file, unzip_specific_folder)
+
+
+def extract_zip(file, folder):
+    with ZipFile(file) as item:
+        item.extractall(folder)
 
 
 if __name__ == '__main__':
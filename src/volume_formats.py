@@ -0,0 +1,201 @@
+"""Output formats of src.conv2nii, written from a volume array and its geometry.
+
+- nii.gz: NIfTI-1, gzipped by blocks compressed in parallel. Each block is
+  a gzip member of its own, a multi-member file that zlib, ITK and nibabel
+  read as one stream.
+- nii: uncompressed NIfTI-1, whose voxels start at byte 352, to memory-map
+  them without copy, e.g. np.memmap(path, dtype, "r", 352, shape).
+- npy: a NumPy array, np.load(path, mmap_mode="r").
+- zarr: a chunked, compressed array store, when zarr is installed.
+
+Every output is written under a temporary name and moved in place once
+complete. Arrays are (slices, rows, columns), the geometry is in the NIfTI
+headers, and in the "affine_lps" entry of the .toml file and zarr
+attributes for the other formats.
+"""
+import collections
+import os
+import pathlib
+import shutil
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.file_io import ensure, part_path
+from src.volume_io import VolumeGeometry
+
+NII_GZ = "nii.gz"
+NII = "nii"
+NPY = "npy"
+ZARR = "zarr"
+FORMATS = (NII_GZ, NII, NPY, ZARR)
+GZIP_LEVEL = 6  # the level of zlib by default, as written by sitk.WriteImage
+GZIP_BLOCK_SIZE = 1 << 22
+ZARR_CHUNKS = (32, 128, 128)
+
+NIFTI_HEADER = struct.Struct("<i10s18sihcB8h3f4h8f3fhbb4f2i80s24s2h6f12f16s4s")
+NIFTI_VOX_OFFSET = 352  # header, then 4 bytes for "no extension"
+NIFTI_DATATYPES = {
+    np.dtype(np.uint8): 2, np.dtype(np.int16): 4, np.dtype(np.int32): 8, np.dtype(np.float32): 16,
+    np.dtype(np.float64): 64, np.dtype(np.int8): 256, np.dtype(np.uint16): 512, np.dtype(np.uint32): 768,
+    np.dtype(np.int64): 1024, np.dtype(np.uint64): 1280,
+}
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0])
+
+
+def output_path(stem: pathlib.Path, output_format: str) -> pathlib.Path:
+    return stem.with_name(f"{stem.name}.{output_format}")
+
+
+def format_of(path: pathlib.Path) -> Optional[str]:
+    """The one of FORMATS given by the extension of path, None for any other extension."""
+    return next((fmt for fmt in FORMATS if path.name.endswith(f".{fmt}")), None)
+
+
+def stem_of(path: pathlib.Path) -> pathlib.Path:
+    """path without the extension of its format, keeping the other dots: scan.v2.nii.gz -> scan.v2"""
+    output_format = format_of(path)
+    if output_format is None:
+        return path.with_suffix("")
+    return path.with_name(path.name[:-len(output_format) - 1])
+
+
+def _quaternion(rotation: np.ndarray) -> Tuple[float, float, float]:
+    """(b, c, d) of the quaternion of a proper rotation matrix, as nifti1_io mat44_to_quatern."""
+    (r11, r12, r13), (r21, r22, r23), (r31, r32, r33) = rotation
+    a = r11 + r22 + r33 + 1
+    if a > 0.5:
+        a = 0.5 * np.sqrt(a)
+        b, c, d = 0.25 * (r32 - r23) / a, 0.25 * (r13 - r31) / a, 0.25 * (r21 - r12) / a
+    else:
+        xd, yd, zd = 1 + r11 - r22 - r33, 1 + r22 - r11 - r33, 1 + r33 - r11 - r22
+        if xd > 1:
+            b = 0.5 * np.sqrt(xd)
+            c, d, a = 0.25 * (r12 + r21) / b, 0.25 * (r13 + r31) / b, 0.25 * (r32 - r23) / b
+        elif yd > 1:
+            c = 0.5 * np.sqrt(yd)
+            b, d, a = 0.25 * (r12 + r21) / c, 0.25 * (r23 + r32) / c, 0.25 * (r13 - r31) / c
+        else:
+            d = 0.5 * np.sqrt(zd)
+            b, c, a = 0.25 * (r13 + r31) / d, 0.25 * (r23 + r32) / d, 0.25 * (r21 - r12) / d
+        if a < 0:
+            b, c, d = -b, -c, -d
+    return float(b), float(c), float(d)
+
+
+def nifti_header(volume: np.ndarray, geometry: VolumeGeometry) -> bytes:
+    """NIfTI-1 header of a (slices, rows, columns) volume, with its 4 bytes of extension flag.
+
+    qform and sform both give the scanner coordinates, RAS as NIfTI wants them.
+    """
+    if volume.dtype.newbyteorder("=") not in NIFTI_DATATYPES:
+        raise ValueError(f"no NIfTI-1 datatype for {volume.dtype}")
+    slices, rows, columns = volume.shape
+    rotation = LPS_TO_RAS @ geometry.direction
+    origin = LPS_TO_RAS @ geometry.origin
+    affine = np.eye(4)
+    affine[:3, :3] = rotation * geometry.spacing
+    affine[:3, 3] = origin
+    qfac = 1.0
+    if np.linalg.det(rotation) < 0:
+        qfac, rotation = -1.0, rotation * [1, 1, -1]
+    header = NIFTI_HEADER.pack(
+        348, b"", b"", 0, 0, b"r", 0,
+        3, columns, rows, slices, 1, 1, 1, 1,
+        0.0, 0.0, 0.0,
+        0, NIFTI_DATATYPES[volume.dtype.newbyteorder("=")], volume.dtype.itemsize * 8, 0,
+        qfac, *(float(v) for v in geometry.spacing), 0.0, 0.0, 0.0, 0.0,
+        float(NIFTI_VOX_OFFSET), 1.0, 0.0,
+        0, 0, 2 | 8,  # mm and s
+        0.0, 0.0, 0.0, 0.0, 0, 0,
+        b"", b"",
+        1, 1,  # scanner anatomical coordinates
+        *_quaternion(rotation), *(float(v) for v in origin),
+        *(float(v) for v in affine[:3].flatten()),
+        b"", b"n+1\0",
+    )
+    return header + b"\0" * (NIFTI_VOX_OFFSET - len(header))
+
+
+def _voxels(volume: np.ndarray) -> memoryview:
+    """Bytes of the voxels, little endian, x fastest: the layout of C ordered (slices, rows, columns)."""
+    volume = np.ascontiguousarray(volume, dtype=volume.dtype.newbyteorder("<"))
+    return memoryview(volume).cast("B")
+
+
+def _gzip_member(data, level: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def gzip_members(data: memoryview, level: int = GZIP_LEVEL, threads: int = 1,
+                 block_size: int = GZIP_BLOCK_SIZE) -> Iterator[bytes]:
+    """Gzip data by blocks, compressed by `threads` threads, zlib releasing the GIL.
+
+    At most twice as many blocks as threads are compressed ahead of the one
+    yielded, so memory stays bounded whatever the size of data.
+    """
+    blocks = (data[start:start + block_size] for start in range(0, len(data), block_size))
+    if threads <= 1:
+        for block in blocks:
+            yield _gzip_member(block, level)
+        return
+    with ThreadPoolExecutor(threads) as executor:
+        pending = collections.deque()
+        for block in blocks:
+            pending.append(executor.submit(_gzip_member, block, level))
+            if len(pending) > 2 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def write_nifti(volume: np.ndarray, geometry: VolumeGeometry, path: pathlib.Path, compressed: bool = True,
+                level: int = GZIP_LEVEL, threads: int = 1) -> None:
+    with part_path(ensure(path)).open("wb") as file:
+        if compressed:
+            file.write(_gzip_member(nifti_header(volume, geometry), level))
+            for member in gzip_members(_voxels(volume), level, threads):
+                file.write(member)
+        else:
+            file.write(nifti_header(volume, geometry))
+            file.write(_voxels(volume))
+    os.replace(part_path(path), path)
+
+
+def write_npy(volume: np.ndarray, path: pathlib.Path) -> None:
+    with part_path(ensure(path)).open("wb") as file:
+        np.lib.format.write_array(file, np.ascontiguousarray(volume), allow_pickle=False)
+    os.replace(part_path(path), path)
+
+
+def write_zarr(volume: np.ndarray, geometry: VolumeGeometry, path: pathlib.Path,
+               chunks: Sequence[int] = ZARR_CHUNKS) -> None:
+    import zarr  # only needed for this format
+
+    part = part_path(ensure(path))
+    if part.exists():
+        shutil.rmtree(part)
+    chunks = tuple(min(chunk, size) for chunk, size in zip(chunks, volume.shape))
+    array = zarr.open_array(str(part), mode="w", shape=volume.shape, chunks=chunks, dtype=volume.dtype)
+    array[...] = volume
+    array.attrs["affine_lps"] = geometry.affine.tolist()
+    os.replace(part, path)
+
+
+def write_volume(volume: np.ndarray, geometry: VolumeGeometry, paths: Sequence[pathlib.Path],
+                 level: int = GZIP_LEVEL, threads: int = 1, chunks: Sequence[int] = ZARR_CHUNKS) -> None:
+    """Write a volume to each of the given paths, in the format given by its extension."""
+    for path in paths:
+        output_format = format_of(path)
+        if output_format in (NII_GZ, NII):
+            write_nifti(volume, geometry, path, output_format == NII_GZ, level, threads)
+        elif output_format == NPY:
+            write_npy(volume, path)
+        elif output_format == ZARR:
+            write_zarr(volume, geometry, path, chunks)
+        else:
+            raise ValueError(f"unknown output format of {path}, not one of {FORMATS}")
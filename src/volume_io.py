@@ -0,0 +1,183 @@
+"""Volumes assembled from dicom slices with pydicom and NumPy.
+
+The alternative to the ImageSeriesReader of SimpleITK behind
+`python -m src.conv2nii --backend numpy`: the pixel data of each slice is
+decoded into its plane of one preallocated (slices, rows, columns) array,
+by several threads if asked, then RescaleSlope and RescaleIntercept are
+applied in place to the whole array. The geometry of the volume comes from
+the metadata DB instead of the files. Peak memory is about one volume, plus
+one decoded slice per thread.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Sequence, Tuple
+
+import numpy as np
+import pydicom
+import SimpleITK as sitk
+
+
+@dataclass
+class VolumeGeometry:
+    """Where the voxels of a volume are in the patient (LPS) space, as in ITK."""
+    origin: np.ndarray  # (3,) center of the first voxel of the first slice, in mm
+    spacing: np.ndarray  # (3,) between columns, rows and slices, in mm
+    direction: np.ndarray  # (3, 3) whose columns are the row, column and slice directions
+
+    @classmethod
+    def from_slices(cls, positions: np.ndarray, orientation: np.ndarray,
+                    pixel_spacing: np.ndarray) -> "VolumeGeometry":
+        """Geometry of a volume from the headers of its slices.
+
+        Parameters
+        ----------
+        positions : np.ndarray
+            (n, 3) ImagePositionPatient of the slices, in the order of the volume
+        orientation : np.ndarray
+            (6,) ImageOrientationPatient of the slices
+        pixel_spacing : np.ndarray
+            (2,) PixelSpacing of the slices, between rows then between columns
+
+        Raises
+        ------
+        ValueError
+            If one of them is missing.
+        """
+        if not (np.isfinite(positions).all() and np.isfinite(orientation).all()
+                and np.isfinite(pixel_spacing).all()):
+            raise ValueError("the slices can not be placed in space")
+        row, column = orientation[:3], orientation[3:]
+        normal = np.cross(row, column)
+        z = positions @ normal
+        slice_spacing = (z[-1] - z[0]) / (len(z) - 1) if len(z) > 1 else 0.0
+        spacing = np.array([pixel_spacing[1], pixel_spacing[0], slice_spacing if slice_spacing > 0 else 1.0])
+        return cls(positions[0], spacing, np.column_stack([row, column, normal]))
+
+    @classmethod
+    def from_image(cls, image: sitk.Image) -> "VolumeGeometry":
+        return cls(np.array(image.GetOrigin()), np.array(image.GetSpacing()),
+                   np.array(image.GetDirection()).reshape(3, 3))
+
+    @property
+    def affine(self) -> np.ndarray:
+        """(4, 4) matrix from (column, row, slice) indices to LPS coordinates in mm."""
+        affine = np.eye(4)
+        affine[:3, :3] = self.direction * self.spacing
+        affine[:3, 3] = self.origin
+        return affine
+
+
+def _rescale(ds: pydicom.Dataset) -> Tuple[float, float]:
+    return float(ds.get("RescaleSlope", 1) or 1), float(ds.get("RescaleIntercept", 0) or 0)
+
+
+def _pixels(ds: pydicom.Dataset, file) -> np.ndarray:
+    """Stored values of a slice. Those of uncompressed slices are read from the pixel data as is."""
+    syntax = ds.file_meta.get("TransferSyntaxUID")
+    if (syntax is not None and not syntax.is_compressed and syntax.is_little_endian
+            and ds.get("SamplesPerPixel", 1) == 1 and int(ds.get("NumberOfFrames", 1) or 1) == 1
+            and ds.BitsAllocated in (8, 16, 32)
+            and (ds.PixelRepresentation == 0 or ds.BitsStored == ds.BitsAllocated)):
+        dtype = np.dtype(f"<{'i' if ds.PixelRepresentation else 'u'}{ds.BitsAllocated // 8}")
+        pixels = np.frombuffer(ds.PixelData, dtype, count=ds.Rows * ds.Columns)
+        return pixels.reshape(ds.Rows, ds.Columns)
+    pixels = ds.pixel_array
+    if pixels.ndim != 2:
+        raise ValueError(f"{file}: only single frame, single sample slices are supported, not {pixels.shape}")
+    return pixels
+
+
+def volume_dtype(ds: pydicom.Dataset, rescales: Sequence[Tuple[float, float]] = ()) -> np.dtype:
+    """Type of the voxels of a volume, given the header of one of its slices.
+
+    As GDCM does, integer pixels with integer slopes and intercepts, like
+    those of most CT, stay integers of the smallest type holding both the
+    stored and the rescaled values. Anything else is float64, the type GDCM
+    gives to the SimpleITK backend.
+
+    Parameters
+    ----------
+    ds : pydicom.Dataset
+        The header of a slice, for the range of the stored values
+    rescales : Sequence[Tuple[float, float]]
+        (RescaleSlope, RescaleIntercept) of all the slices, those of ds if empty
+    """
+    rescales = rescales or [_rescale(ds)]
+    if not all(slope.is_integer() and intercept.is_integer() for slope, intercept in rescales) \
+            or ds.get("BitsStored") is None:
+        return np.dtype(np.float64)
+    bits = int(ds.BitsStored)
+    if ds.get("PixelRepresentation", 0) == 1:
+        low, high = -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+    else:
+        low, high = 0, (1 << bits) - 1
+    bounds = [low, high]
+    for slope, intercept in set(rescales):
+        bounds.extend((low * int(slope) + int(intercept), high * int(slope) + int(intercept)))
+    types = (np.int8, np.int16, np.int32, np.int64) if min(bounds) < 0 else (np.uint8, np.uint16, np.uint32, np.uint64)
+    for dtype in types:
+        if np.iinfo(dtype).min <= min(bounds) and max(bounds) <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.float64)
+
+
+def read_volume(files: Sequence[str], threads: int = 1) -> np.ndarray:
+    """Pixel values of the slices of a volume, rescaled, in one (slices, rows, columns) array.
+
+    Parameters
+    ----------
+    files : Sequence[str]
+        The .dcm files, ordered along the slice axis
+    threads : int
+        Number of slices decoded at once
+
+    Returns
+    -------
+    np.ndarray
+        The volume, with the dtype given by volume_dtype for all its slices.
+    """
+    first = pydicom.dcmread(str(files[0]))
+    pixels = _pixels(first, files[0])
+    volume = np.empty((len(files), *pixels.shape), dtype=volume_dtype(first))
+    volume[0] = pixels
+    del pixels
+
+    def decode(index: int) -> Tuple[float, float]:
+        ds = pydicom.dcmread(str(files[index]))
+        pixels = _pixels(ds, files[index])
+        if pixels.shape != volume.shape[1:]:
+            raise ValueError(f"{files[index]}: {pixels.shape} slice in a {volume.shape[1:]} volume")
+        volume[index] = pixels
+        return _rescale(ds)
+
+    rescales: List[Tuple[float, float]] = [_rescale(first)]
+    if threads > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            rescales.extend(executor.map(decode, range(1, len(files))))
+    else:
+        rescales.extend(map(decode, range(1, len(files))))
+    dtype = volume_dtype(first, rescales)
+    if dtype != volume.dtype:
+        # the rescale of a later slice needs a larger type than the first one, rare enough to afford the copy
+        volume = volume.astype(dtype)
+    slopes, intercepts = (np.array(values)[:, None, None] for values in zip(*rescales))
+    if dtype.kind != "f":
+        if (slopes != 1).any():
+            volume *= slopes.astype(dtype)
+        if intercepts.any():
+            volume += intercepts.astype(dtype)
+        return volume
+    if (slopes != 1).any():
+        volume *= slopes
+    if intercepts.any():
+        volume += intercepts
+    return volume
+
+
+def volume_to_image(volume: np.ndarray, geometry: VolumeGeometry) -> sitk.Image:
+    """SimpleITK image of a volume, to write it with sitk.WriteImage. The voxels are copied."""
+    image = sitk.GetImageFromArray(volume)
+    image.SetOrigin(tuple(float(v) for v in geometry.origin))
+    image.SetSpacing(tuple(float(v) for v in geometry.spacing))
+    image.SetDirection(tuple(float(v) for v in geometry.direction.flatten()))
+    return image
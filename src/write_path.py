@@ -0,0 +1,91 @@
+"""Copy an HTTP response body to disk with few, large writes.
+
+The body is read into one preallocated buffer, reused for the whole transfer,
+instead of allocating a new bytes object for every small chunk.
+"""
+import errno
+import logging
+import os
+from dataclasses import dataclass
+from typing import BinaryIO, Callable, Iterable, Optional
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class WriteOptions:
+    buffer_size: int = 1 << 20  # bytes read and written at once
+    preallocate: bool = True  # reserve the file size when it is known
+    fsync_bytes: int = 0  # fsync each time this many bytes were written, and at the end. 0: never
+
+
+def _preallocate(fd: int, offset: int, length: int) -> None:
+    try:
+        os.posix_fallocate(fd, offset, length)
+    except (AttributeError, OSError) as error:
+        # not available on this platform or file system, e.g. some NFS
+        if isinstance(error, OSError) and error.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+            raise
+        log.debug("posix_fallocate not supported: %s", error)
+
+
+def stream_to_file(raw: BinaryIO, file: Optional[BinaryIO], options: WriteOptions = WriteOptions(),
+                   length: Optional[int] = None, consumers: Iterable[Callable] = ()) -> int:
+    """Write everything readable from raw into file.
+
+    Parameters
+    ----------
+    raw : BinaryIO
+        The response body, with a readinto method, e.g. requests' Response.raw.
+    file : BinaryIO, optional
+        An open file, positioned where to write. If None, the body is only
+        passed to the consumers.
+    options : WriteOptions
+        Buffer size, preallocation and fsync policy
+    length : int, optional
+        Number of bytes expected, used to preallocate the file.
+    consumers : Iterable[Callable]
+        Called with each memoryview written, e.g. a hash update method.
+        The view is only valid during the call.
+
+    Returns
+    -------
+    int
+        The number of bytes written.
+
+    Note
+    ----
+    If the transfer fails, the file is truncated to the bytes actually
+    written, so the preallocated space does not look like downloaded data.
+    """
+    view = memoryview(bytearray(options.buffer_size))
+    consumers = list(consumers)
+    if file is not None:
+        consumers.insert(0, file.write)
+        start = file.tell()
+        if options.preallocate and length:
+            file.flush()
+            _preallocate(file.fileno(), start, length)
+    written = 0
+    unsynced = 0
+    try:
+        while True:
+            count = raw.readinto(view)
+            if not count:
+                break
+            chunk = view[:count]
+            for consumer in consumers:
+                consumer(chunk)
+            written += count
+            unsynced += count
+            if file is not None and options.fsync_bytes and unsynced >= options.fsync_bytes:
+                file.flush()
+                os.fsync(file.fileno())
+                unsynced = 0
+    finally:
+        if file is not None:
+            file.truncate(start + written)
+    if file is not None and options.fsync_bytes:
+        file.flush()
+        os.fsync(file.fileno())
+    return written